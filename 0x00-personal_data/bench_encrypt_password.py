@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+""" benchmark of batch password hashing against the serial loop"""
+
+import sys
+import time
+
+from encrypt_password import (
+    WORKERS,
+    are_valid,
+    hash_password,
+    hash_passwords,
+    is_valid,
+)
+
+
+def timed(label: str, count: int, func) -> float:
+    """runs func, prints and returns its duration"""
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {elapsed:8.3f}s {count / elapsed:8.1f}/s")
+    return elapsed
+
+
+def main(count: int = 32):
+    """compares serial and thread pool hashing and verification"""
+    passwords = [f"password{i}" for i in range(count)]
+    hashed = [hash_password(password) for password in passwords]
+    pairs = list(zip(hashed, passwords))
+    print(f"{count} passwords, {WORKERS} workers")
+    serial = timed("hash serial", count,
+                   lambda: [hash_password(p) for p in passwords])
+    pooled = timed("hash_passwords", count,
+                   lambda: hash_passwords(passwords))
+    print(f"speedup {serial / pooled:.2f}x")
+    serial = timed("is_valid serial", count,
+                   lambda: [is_valid(h, p) for h, p in pairs])
+    pooled = timed("are_valid", count, lambda: are_valid(pairs))
+    print(f"speedup {serial / pooled:.2f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
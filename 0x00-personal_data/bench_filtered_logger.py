@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+""" benchmark of the PII redaction pipeline of filtered_logger
+
+usage: ./bench_filtered_logger.py [--save FILE] [--compare FILE]
+                                  [--threshold RATIO]
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import filtered_logger
+from filtered_logger import RedactingFormatter, filter_datum, get_logger
+
+FIELD_COUNTS = (5, 50)
+VALUE_SIZES = (8, 256)
+SEPARATORS = (";", ", ")
+REDACTION_RATIOS = (0.0, 0.5, 1.0)
+REGRESSION = 0.10
+ALLOC_RECORDS = 200
+
+
+def make_case(count: int, size: int, separator: str, ratio: float) -> dict:
+    """returns the fields and the message of one benchmark case"""
+    names = [f"field{i}" for i in range(count)]
+    fields = names[:round(count * ratio)] or ["absent"]
+    data = {name: "v" * size for name in names}
+    message = "".join(f"{k}={v}{separator}" for k, v in data.items())
+    return {"fields": fields, "data": data, "message": message}
+
+
+def allocations(func: Callable,
+                records: int = ALLOC_RECORDS) -> Dict[str, float]:
+    """returns the bytes one call allocates: the average of the peaks of
+    records calls, and what they keep allocated, per call"""
+    func()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    peaks = 0
+    for _ in range(records):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        peaks += tracemalloc.get_traced_memory()[1] - current
+    retained = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return {"peak_bytes": peaks / records,
+            "retained_bytes": retained / records}
+
+
+def measure(func: Callable, repeat: int = 5,
+            min_time: float = 0.05) -> Dict[str, float]:
+    """returns the best messages per second of repeat rounds and the
+    bytes allocated per call"""
+    result = allocations(func)
+    best = 0.0
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < min_time:
+            for _ in range(50):
+                func()
+            calls += 50
+            elapsed = time.perf_counter() - start
+        best = max(best, calls / elapsed)
+    result["msgs_per_sec"] = best
+    return result
+
+
+def record(msg) -> logging.LogRecord:
+    """returns a log record carrying msg"""
+    return logging.LogRecord("user_data", logging.INFO, None, None,
+                             msg, None, None)
+
+
+def stream_handlers(logger: logging.Logger) -> List[logging.Handler]:
+    """returns the handlers writing the records of logger, behind the
+    queue listener in asynchronous mode"""
+    handlers = list(logger.handlers)
+    if filtered_logger._listener is not None:
+        handlers.extend(filtered_logger._listener.handlers)
+    return [h for h in handlers if isinstance(h, logging.StreamHandler)]
+
+
+def run() -> Dict[str, dict]:
+    """runs every case of the matrix, returns results by case name
+
+    The logger case goes through the handlers of get_logger(), which
+    format with the redacting formatter of the case.
+    """
+    logger = get_logger()
+    handlers = stream_handlers(logger)
+    for handler in handlers:
+        handler.setStream(open(os.devnull, "w"))
+    results = {}
+    matrix = itertools.product(FIELD_COUNTS, VALUE_SIZES, SEPARATORS,
+                               REDACTION_RATIOS)
+    for count, size, separator, ratio in matrix:
+        case = make_case(count, size, separator, ratio)
+        formatter = type("Formatter", (RedactingFormatter,),
+                         {"SEPARATOR": separator})(case["fields"])
+        text, data = record(case["message"]), record(case["data"])
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        benches = {
+            "filter_datum": lambda: filter_datum(
+                case["fields"], "***", case["message"], separator),
+            "format": lambda: formatter.format(text),
+            "format_structured": lambda: formatter.format(data),
+            "logger": lambda: logger.info(case["message"]),
+        }
+        for bench, func in benches.items():
+            name = f"{bench} n={count} size={size} sep={separator!r} " \
+                   f"ratio={ratio}"
+            results[name] = measure(func)
+            print(f"{name:<60} {results[name]['msgs_per_sec']:>12.0f}/s "
+                  f"{results[name]['peak_bytes']:>8.0f}B peak "
+                  f"{results[name]['retained_bytes']:>6.0f}B kept")
+    return results
+
+
+def compare(old: Dict[str, dict], new: Dict[str, dict],
+            threshold: float = REGRESSION) -> List[str]:
+    """prints throughput changes, returns the regressed case names"""
+    regressed = []
+    for name, result in new.items():
+        if name not in old:
+            continue
+        ratio = result["msgs_per_sec"] / old[name]["msgs_per_sec"]
+        flag = ""
+        if ratio < 1 - threshold:
+            regressed.append(name)
+            flag = " REGRESSION"
+        print(f"{name:<60} {ratio:>6.2f}x{flag}")
+    return regressed
+
+
+def main():
+    """runs the benchmark, optionally saving and comparing results"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare with a saved JSON file")
+    parser.add_argument("--threshold", type=float, default=REGRESSION,
+                        help="slowdown reported as a regression")
+    args = parser.parse_args()
+    results = run()
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(json.load(f), results, args.threshold)
+        print(f"{len(regressed)} regressions")
+        if regressed:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
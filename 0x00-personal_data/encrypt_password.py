@@ -1,14 +1,192 @@
 #!/usr/bin/env python3
 """ implementation of password functions"""
 
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
 import bcrypt
 
+WORKERS = os.cpu_count() or 1
+TARGET_MS = 250
+MIN_ROUNDS = 12
+MAX_ROUNDS = 31
+
+_rounds = None
+_rounds_lock = threading.Lock()
+
+
+def calibrate_rounds(
+    target_ms: float = TARGET_MS,
+    probe: int = 8,
+    min_rounds: int = MIN_ROUNDS,
+) -> int:
+    """returns the highest bcrypt cost hashing within target_ms here, and
+    never below min_rounds
+
+    One hash is timed at the probe cost; each extra round doubles it.
+    """
+    salt = bcrypt.gensalt(probe)
+    start = time.perf_counter()
+    bcrypt.hashpw(b"calibration", salt)
+    elapsed = (time.perf_counter() - start) * 1000
+    rounds = probe
+    while rounds < MAX_ROUNDS and elapsed * 2 <= target_ms:
+        elapsed *= 2
+        rounds += 1
+    while rounds > min_rounds and elapsed > target_ms:
+        elapsed /= 2
+        rounds -= 1
+    return max(rounds, min_rounds)
+
+
+def target_rounds() -> int:
+    """returns the bcrypt cost new hashes use on this machine
+
+    PERSONAL_DATA_BCRYPT_ROUNDS pins it, otherwise it is calibrated once
+    against PERSONAL_DATA_BCRYPT_TARGET_MS, never below
+    PERSONAL_DATA_BCRYPT_MIN_ROUNDS. Call it at startup, or before
+    hashing in parallel as the batch functions do, so that the probe is
+    not timed against concurrent hashes.
+    """
+    global _rounds
+    if _rounds is not None:
+        return _rounds
+    with _rounds_lock:
+        if _rounds is None:
+            rounds = os.getenv("PERSONAL_DATA_BCRYPT_ROUNDS")
+            if rounds:
+                _rounds = int(rounds)
+            else:
+                _rounds = calibrate_rounds(
+                    float(os.getenv("PERSONAL_DATA_BCRYPT_TARGET_MS",
+                                    TARGET_MS)),
+                    min_rounds=int(os.getenv(
+                        "PERSONAL_DATA_BCRYPT_MIN_ROUNDS", MIN_ROUNDS)),
+                )
+    return _rounds
+
 
 def hash_password(password: str) -> bytes:
     """returns a salted, hashed password"""
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    return bcrypt.hashpw(
+        password.encode("utf-8"),
+        bcrypt.gensalt(target_rounds()),
+    )
 
 
 def is_valid(hashed_password: bytes, password: str) -> bool:
     """validates that the provided password matches the hashed password."""
     return bcrypt.checkpw(password.encode("utf-8"), hashed_password)
+
+
+def hash_rounds(hashed_password: bytes) -> int:
+    """returns the bcrypt cost a hashed password was made with"""
+    return int(hashed_password.split(b"$")[2])
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """tells whether a hashed password uses a lower cost than the target
+
+    Stronger hashes are kept, so hosts calibrated to different costs do
+    not keep rehashing each other's passwords.
+    """
+    return hash_rounds(hashed_password) < target_rounds()
+
+
+def verify_and_update(
+    hashed_password: bytes,
+    password: str,
+) -> Tuple[bool, Optional[bytes]]:
+    """validates a password, returning a new hash when it needs one
+
+    The second value is None unless the password is valid and its
+    stored hash uses a lower cost than the current target.
+    """
+    if not is_valid(hashed_password, password):
+        return False, None
+    if needs_rehash(hashed_password):
+        return True, hash_password(password)
+    return True, None
+
+
+def _map_ordered(
+    func: Callable,
+    items: Iterable[tuple],
+    workers: int,
+) -> Iterator[Any]:
+    """yields func(*item) for every item, in order, from a thread pool
+
+    At most 2 * workers calls are in flight, so items may be a lazy
+    iterable of any length.
+    """
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, *item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _map_as_completed(
+    func: Callable,
+    items: Iterable[tuple],
+    workers: int,
+) -> Iterator[Tuple[int, Any]]:
+    """yields (index, func(*item)) pairs as soon as each call finishes"""
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {}
+        for index, item in enumerate(items):
+            pending[executor.submit(func, *item)] = index
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        for future in as_completed(pending):
+            yield pending[future], future.result()
+
+
+def hash_passwords(
+    passwords: Iterable[str],
+    workers: int = WORKERS,
+) -> List[bytes]:
+    """returns the hashes of passwords, in order, hashed in parallel"""
+    target_rounds()
+    items = ((password,) for password in passwords)
+    return list(_map_ordered(hash_password, items, workers))
+
+
+def hash_passwords_as_completed(
+    passwords: Iterable[str],
+    workers: int = WORKERS,
+) -> Iterator[Tuple[int, bytes]]:
+    """yields (index, hash) pairs of passwords as they are hashed"""
+    target_rounds()
+    items = ((password,) for password in passwords)
+    return _map_as_completed(hash_password, items, workers)
+
+
+def are_valid(
+    pairs: Iterable[Tuple[bytes, str]],
+    workers: int = WORKERS,
+) -> List[bool]:
+    """validates (hashed_password, password) pairs in parallel, in order"""
+    return list(_map_ordered(is_valid, pairs, workers))
+
+
+def are_valid_as_completed(
+    pairs: Iterable[Tuple[bytes, str]],
+    workers: int = WORKERS,
+) -> Iterator[Tuple[int, bool]]:
+    """yields (index, validity) of (hashed_password, password) pairs"""
+    return _map_as_completed(is_valid, pairs, workers)
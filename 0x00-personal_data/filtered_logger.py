@@ -1,10 +1,22 @@
 #!/usr/bin/env python3
 """ script of filtered_logger.py """
 import re
-from typing import List
+import argparse
+import atexit
+import mmap
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import IO, Iterator, List, Mapping, Pattern, Tuple, Union
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Pool
 import os
-from mysql.connector import connection
+from mysql.connector import connection, pooling
 
 PII_FIELDS = (
     "name",
@@ -13,6 +25,26 @@ PII_FIELDS = (
     "ssn",
     "password",
 )
+BATCH_SIZE = 1000
+QUEUE_SIZE = 10000
+OVERFLOW_POLICIES = ("block", "drop", "sample")
+SAMPLE_RATE = 10
+POOL_NAME = "personal_data"
+POOL_SIZE = 5
+EXPORT_KEY = "email"
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+@lru_cache(maxsize=None)
+def compile_fields(fields: Tuple[str, ...], separator: str) -> Pattern:
+    """returns one pattern matching every field, compiled once per fields"""
+    alternation = "|".join(re.escape(field) for field in fields)
+    return re.compile(rf"({alternation})=.*?{re.escape(separator)}")
+
+
+def redaction_template(redaction: str, separator: str) -> str:
+    """returns the substitution template for a compiled fields pattern"""
+    return r"\1=" + f"{redaction}{separator}".replace("\\", r"\\")
 
 
 def filter_datum(
@@ -22,13 +54,10 @@ def filter_datum(
     separator: str,
 ) -> str:
     """returns the log message obfuscated"""
-    for field in fields:
-        pattern = re.compile(
-            rf"{re.escape(field)}=.*?{re.escape(separator)}",
-        )
-        replacement = f"{field}={redaction}{separator}"
-        message = re.sub(pattern, replacement, message)
-    return message
+    if not fields:
+        return message
+    pattern = compile_fields(tuple(fields), separator)
+    return pattern.sub(redaction_template(redaction, separator), message)
 
 
 class RedactingFormatter(logging.Formatter):
@@ -42,55 +71,488 @@ class RedactingFormatter(logging.Formatter):
         """Initializes the RedactingFormatter"""
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self._pii = frozenset(fields)
+        self._pattern = compile_fields(tuple(fields), self.SEPARATOR)
+        self._template = redaction_template(self.REDACTION, self.SEPARATOR)
+
+    def redact(self, record: logging.LogRecord) -> str:
+        """returns the redacted message of a record
+
+        A mapping passed as the message, or as ``extra={"data": ...}``,
+        is redacted by key lookup; any other message is scanned.
+        """
+        data = getattr(record, "data", record.msg)
+        if isinstance(data, Mapping):
+            return "".join(
+                f"{key}={self.REDACTION if key in self._pii else value}"
+                f"{self.SEPARATOR} "
+                for key, value in data.items()
+            )
+        message = record.getMessage()
+        if not self.fields:
+            return message
+        return self._pattern.sub(self._template, message)
 
     def format(self, record: logging.LogRecord) -> str:
-        """Formats a log record, redacting specified fields."""
-        record.msg = filter_datum(
-            self.fields,
-            self.REDACTION,
-            record.msg,
-            self.SEPARATOR,
-        )
-        return super().format(record)
+        """Formats a log record, redacting specified fields.
+
+        The record itself is left untouched so that every handler
+        formats the original message exactly once.
+        """
+        redacted = logging.makeLogRecord(record.__dict__)
+        redacted.msg = self.redact(record)
+        redacted.args = None
+        return super().format(redacted)
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    """StreamHandler writing its records in batches of capacity lines"""
+
+    def __init__(self, stream=None, capacity: int = BATCH_SIZE):
+        """Initializes the BatchStreamHandler"""
+        super(BatchStreamHandler, self).__init__(stream)
+        self.capacity = capacity
+        self.buffer = []
+
+    def emit(self, record: logging.LogRecord):
+        """Buffers a formatted record, writing once the batch is full."""
+        try:
+            self.buffer.append(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.buffer) >= self.capacity:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered batch with a single write call."""
+        self.acquire()
+        try:
+            if self.buffer and self.stream:
+                self.stream.write("".join(self.buffer))
+                self.buffer = []
+            super(BatchStreamHandler, self).flush()
+        finally:
+            self.release()
+
+
+class BoundedQueueHandler(QueueHandler):
+    """QueueHandler applying an overflow policy to a bounded queue
+
+    ``block`` waits for room, ``drop`` discards records while the queue
+    is full and ``sample`` keeps one record in sample_rate once the
+    queue is half full, dropping the rest.
+    """
+
+    def __init__(self, log_queue: queue.Queue, overflow: str = "block",
+                 sample_rate: int = SAMPLE_RATE):
+        """Initializes the BoundedQueueHandler"""
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy: {overflow}")
+        super(BoundedQueueHandler, self).__init__(log_queue)
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        self._sampled = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Leaves formatting and redaction to the listener thread."""
+        return record
 
+    def enqueue(self, record: logging.LogRecord):
+        """Enqueues a record according to the overflow policy."""
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        if self.overflow == "sample" \
+                and self.queue.qsize() * 2 >= self.queue.maxsize:
+            self._sampled += 1
+            if self._sampled % self.sample_rate:
+                self.dropped += 1
+                return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
-def get_logger() -> logging.Logger:
-    """creates user_data logger"""
+
+class BatchQueueListener(QueueListener):
+    """QueueListener flushing its handlers whenever the queue drains"""
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        """Flushes pending batches before waiting on an empty queue."""
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+        return self.queue.get(block)
+
+    def enqueue_sentinel(self):
+        """Waits for room in a full queue rather than losing the sentinel."""
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        """Stops a running listener and writes whatever is still buffered."""
+        if self._thread is None:
+            return
+        super(BatchQueueListener, self).stop()
+        for handler in self.handlers:
+            handler.flush()
+
+
+_listener = None
+
+
+def get_logger(
+    batch_size: int = 1,
+    asynchronous: bool = None,
+    queue_size: int = None,
+    overflow: str = None,
+) -> logging.Logger:
+    """creates user_data logger, once
+
+    In asynchronous mode records go through a bounded queue to a single
+    background listener that redacts and writes them in batches.
+    """
+    global _listener
     user_data = logging.getLogger("user_data")
+    if user_data.handlers:
+        return user_data
     user_data.setLevel(logging.INFO)
     user_data.propagate = False
-    stream_handler = logging.StreamHandler()
+    if asynchronous is None:
+        asynchronous = os.getenv("PERSONAL_DATA_LOG_ASYNC", "0") == "1"
+    if asynchronous:
+        if queue_size is None:
+            queue_size = int(os.getenv("PERSONAL_DATA_LOG_QUEUE_SIZE",
+                                       QUEUE_SIZE))
+        if overflow is None:
+            overflow = os.getenv("PERSONAL_DATA_LOG_OVERFLOW", "block")
+        log_queue = queue.Queue(queue_size)
+        queue_handler = BoundedQueueHandler(log_queue, overflow)
+        stream_handler = BatchStreamHandler(
+            capacity=batch_size if batch_size > 1 else BATCH_SIZE,
+        )
+        stream_handler.setFormatter(RedactingFormatter(PII_FIELDS))
+        _listener = BatchQueueListener(log_queue, stream_handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+        user_data.addHandler(queue_handler)
+        return user_data
+    if batch_size > 1:
+        stream_handler = BatchStreamHandler(capacity=batch_size)
+    else:
+        stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(RedactingFormatter(PII_FIELDS))
     user_data.addHandler(stream_handler)
     return user_data
 
 
-def get_db() -> connection.MySQLConnection:
-    """returns a connector to the database"""
-    db_name = os.getenv("PERSONAL_DATA_DB_NAME")
-    username = os.getenv("PERSONAL_DATA_DB_USERNAME", "root")
-    password = os.getenv("PERSONAL_DATA_DB_PASSWORD", "")
-    host = os.getenv("PERSONAL_DATA_DB_HOST", "localhost")
-    return connection.MySQLConnection(
-        host=host,
-        username=username,
-        password=password,
-        database=db_name,
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def db_config() -> dict:
+    """returns the database settings read from the environment"""
+    return {
+        "host": os.getenv("PERSONAL_DATA_DB_HOST", "localhost"),
+        "username": os.getenv("PERSONAL_DATA_DB_USERNAME", "root"),
+        "password": os.getenv("PERSONAL_DATA_DB_PASSWORD", ""),
+        "database": os.getenv("PERSONAL_DATA_DB_NAME"),
+    }
+
+
+def get_pool() -> pooling.MySQLConnectionPool:
+    """returns the connection pool of this process, creating it once"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = pooling.MySQLConnectionPool(
+                pool_name=os.getenv("PERSONAL_DATA_DB_POOL_NAME", POOL_NAME),
+                pool_size=int(os.getenv("PERSONAL_DATA_DB_POOL_SIZE",
+                                        POOL_SIZE)),
+                **db_config(),
+            )
+        return _pool
+
+
+def get_db(
+    pooled: bool = False,
+) -> Union[connection.MySQLConnection, pooling.PooledMySQLConnection]:
+    """returns a connector to the database
+
+    A pooled connection goes back to the pool when it is closed.
+    """
+    if pooled:
+        return get_pool().get_connection()
+    return connection.MySQLConnection(**db_config())
+
+
+@contextmanager
+def db_connection() -> Iterator[pooling.PooledMySQLConnection]:
+    """checks a pooled connection out for the duration of the block"""
+    db = get_db(pooled=True)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def stream_rows(cursor, batch_size: int = BATCH_SIZE) -> Iterator[dict]:
+    """yields the rows of an executed cursor, batch_size rows at a time"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def export_key() -> str:
+    """returns the column cutting the users table into slices"""
+    key = os.getenv("PERSONAL_DATA_DB_KEY", EXPORT_KEY)
+    if not key.isidentifier():
+        raise ValueError(f"invalid key column: {key}")
+    return key
+
+
+def check_unique_key(db: connection.MySQLConnection, key: str):
+    """raises ValueError unless a unique index covers key alone and key
+    is NOT NULL, since key ranges never match NULL"""
+    cursor = db.cursor(dictionary=True)
+    cursor.execute("SHOW INDEX FROM users;")
+    indexes, nullable = {}, False
+    for index in cursor.fetchall():
+        if not int(index["Non_unique"]):
+            indexes.setdefault(index["Key_name"], []).append(
+                index["Column_name"],
+            )
+        if index["Column_name"] == key and index["Null"] == "YES":
+            nullable = True
+    cursor.close()
+    if [key] not in indexes.values():
+        raise ValueError(f"no unique index on users.{key} to export by")
+    if nullable:
+        raise ValueError(f"users.{key} allows NULL, export by a NOT NULL "
+                         "key")
+
+
+def slice_bounds(
+    db: connection.MySQLConnection,
+    key: str,
+    batch_size: int,
+) -> List[Tuple]:
+    """returns the (lower, upper) key ranges of batch_size rows covering
+    the users table, read from the index of key"""
+    cursor = db.cursor(buffered=False)
+    cursor.execute(f"SELECT {key} FROM users ORDER BY {key};")
+    bounds, lower, count = [], None, 0
+    for (value,) in stream_rows(cursor):
+        count += 1
+        if count % batch_size == 0:
+            bounds.append((lower, value))
+            lower = value
+    cursor.close()
+    if count % batch_size:
+        bounds.append((lower, None))
+    return bounds
+
+
+_worker_db = None
+_worker_formatter = None
+
+
+def init_export_worker():
+    """opens the connection an export worker keeps for all its slices"""
+    global _worker_db, _worker_formatter
+    _worker_db = get_db()
+    _worker_formatter = RedactingFormatter(PII_FIELDS)
+
+
+def export_slice(bounds: Tuple) -> Tuple[str, int]:
+    """returns the log lines of one key range of the users table, as
+    the user_data logger formats them, and their number"""
+    lower, upper = bounds
+    key = export_key()
+    where, params = [], []
+    if lower is not None:
+        where.append(f"{key} > %s")
+        params.append(lower)
+    if upper is not None:
+        where.append(f"{key} <= %s")
+        params.append(upper)
+    where = f" WHERE {' AND '.join(where)}" if where else ""
+    cursor = _worker_db.cursor(dictionary=True, buffered=False)
+    cursor.execute(
+        f"SELECT * FROM users{where} ORDER BY {key};",
+        params,
     )
+    lines = []
+    for row in stream_rows(cursor):
+        record = logging.makeLogRecord({
+            "name": "user_data",
+            "levelno": logging.INFO,
+            "levelname": "INFO",
+            "msg": row,
+        })
+        lines.append(_worker_formatter.format(record) + "\n")
+    cursor.close()
+    return "".join(lines), len(lines)
 
 
-def main():
-    """main function"""
+def export_users(logger: logging.Logger, batch_size: int) -> int:
+    """logs every row of the users table, returns the number of rows"""
     db = get_db()
-    cursor = db.cursor(dictionary=True)
+    cursor = db.cursor(dictionary=True, buffered=False)
     cursor.execute("SELECT * FROM users;")
-    logger = get_logger()
-    for row in cursor:
-        line = ""
-        for key, value in row.items():
-            line += f"{key}={value}; "
-        logger.info(line)
+    count = 0
+    for row in stream_rows(cursor, batch_size):
+        logger.info(row)
+        count += 1
+    cursor.close()
+    db.close()
+    return count
+
+
+def export_users_parallel(
+    stream: IO,
+    workers: int,
+    batch_size: int,
+) -> int:
+    """writes the log line of every row of the users table to stream,
+    fetched and formatted by worker processes
+
+    The table is cut into ranges of batch_size rows of export_key(),
+    which must be NOT NULL with a unique index; ranges are written back
+    in key order, at most 2 * workers of them being in memory. Each
+    worker keeps one connection for all its ranges.
+    """
+    key = export_key()
+    db = get_db()
+    try:
+        check_unique_key(db, key)
+        slices = slice_bounds(db, key, batch_size)
+    finally:
+        db.close()
+    count = 0
+    with Pool(workers, initializer=init_export_worker) as pool:
+        pending = deque()
+        for bounds in slices:
+            pending.append(pool.apply_async(export_slice, (bounds,)))
+            if len(pending) >= 2 * workers:
+                lines, rows = pending.popleft().get()
+                stream.write(lines)
+                count += rows
+        while pending:
+            lines, rows = pending.popleft().get()
+            stream.write(lines)
+            count += rows
+    stream.flush()
+    return count
+
+
+def main(batch_size: int = None, workers: int = None):
+    """main function"""
+    if batch_size is None:
+        batch_size = int(os.getenv("PERSONAL_DATA_BATCH_SIZE", BATCH_SIZE))
+    if workers is None:
+        workers = int(os.getenv("PERSONAL_DATA_WORKERS", 1))
+    logger = get_logger(batch_size)
+    start = time.perf_counter()
+    if workers > 1:
+        count = export_users_parallel(sys.stderr, workers, batch_size)
+    else:
+        count = export_users(logger, batch_size)
+    for handler in logger.handlers:
+        handler.flush()
+    if workers > 1:
+        elapsed = time.perf_counter() - start
+        print(
+            f"exported {count} rows in {elapsed:.2f}s "
+            f"({count / elapsed:.0f} rows/s) with {workers} workers",
+            file=sys.stderr,
+        )
+
+
+def chunk_bounds(
+    mapped: mmap.mmap,
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[Tuple[int, int]]:
+    """yields line-aligned (start, end) offsets covering mapped"""
+    start, size = 0, len(mapped)
+    while start < size:
+        end = mapped.find(b"\n", min(start + chunk_size, size) - 1)
+        end = size if end == -1 else end + 1
+        yield start, end
+        start = end
+
+
+def redact_chunk(job: Tuple[str, int, int]) -> bytes:
+    """returns one chunk of a log file with its PII fields redacted"""
+    path, start, end = job
+    with open(path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        text = mapped[start:end].decode("utf-8", "surrogateescape")
+    return filter_datum(
+        PII_FIELDS,
+        RedactingFormatter.REDACTION,
+        text,
+        RedactingFormatter.SEPARATOR,
+    ).encode("utf-8", "surrogateescape")
+
+
+def redact_file(
+    source: str,
+    destination: str,
+    workers: int = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """writes a redacted copy of a log file, returns the bytes read
+
+    The source is memory-mapped and cut into line-aligned chunks that
+    worker processes redact; at most 2 * workers chunks are in memory.
+    """
+    workers = workers or os.cpu_count() or 1
+    with open(source, "rb") as f, open(destination, "wb") as out:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+                Pool(workers) as pool:
+            pending = deque()
+            for start, end in chunk_bounds(mapped, chunk_size):
+                pending.append(
+                    pool.apply_async(redact_chunk, ((source, start, end),)),
+                )
+                if len(pending) >= 2 * workers:
+                    out.write(pending.popleft().get())
+            while pending:
+                out.write(pending.popleft().get())
+    return size
+
+
+def cli(argv: List[str] = None):
+    """command line entry point: exports the users table or, with the
+    redact command, scrubs existing log files"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command")
+    redact = commands.add_parser("redact", help="redact a log file")
+    redact.add_argument("source")
+    redact.add_argument("destination")
+    redact.add_argument("--workers", type=int)
+    redact.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    if args.command != "redact":
+        main()
+        return
+    start = time.perf_counter()
+    size = redact_file(args.source, args.destination, args.workers,
+                       args.chunk_size)
+    elapsed = time.perf_counter() - start
+    print(
+        f"redacted {size} bytes in {elapsed:.2f}s "
+        f"({size / elapsed / 2 ** 20:.1f} MiB/s)",
+        file=sys.stderr,
+    )
 
 
 if __name__ == "__main__":
-    main()
+    cli()
@@ -13,10 +13,10 @@ class SessionDBAuth(SessionExpAuth):
         session_id = super().create_session(user_id)
         if not session_id:
             return None
+        UserSession.refresh_if_changed()
         args = {"user_id": user_id, "session_id": session_id}
         user_session = UserSession(**args)
         user_session.save()
-        user_session.save_to_file()
         return session_id
 
     def user_id_for_session_id(self, session_id=None):
@@ -24,7 +24,7 @@ class SessionDBAuth(SessionExpAuth):
         if not session_id:
             return None
 
-        UserSession.load_from_file()
+        UserSession.refresh_if_changed()
         user_session = UserSession.search({'session_id': session_id})
         if not user_session:
             return None
@@ -48,5 +48,4 @@ class SessionDBAuth(SessionExpAuth):
         if not user_session:
             return False
         user_session[0].remove()
-        UserSession.save_to_file()
         return True
@@ -2,18 +2,93 @@
 """ Module of Users views
 """
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from flask import Response, abort, jsonify, request
+from flask import url_for
+from models.base import version_scope
+from models.query import After
 from models.user import User
+from typing import Iterable, Iterator
+
+
+MAX_LIMIT = 1000
+
+
+def make_etag(*parts) -> str:
+    """ Return an entity tag made of versions, valid in version_scope()
+    """
+    return ".".join(str(part) for part in (version_scope(),) + parts)
+
+
+def not_modified(etag: str) -> Response:
+    """ Return a 304 response for an entity tag the client already has,
+    None if it has not
+    """
+    if not request.if_none_match.contains(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def stream_json(users: Iterable[User]) -> Iterator[bytes]:
+    """ Yield a JSON array of users one element at a time
+    """
+    yield b"["
+    for i, user in enumerate(users):
+        if i:
+            yield b","
+        yield user.to_json_bytes()
+    yield b"]\n"
 
 
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters:
+      - limit (optional): page size, up to MAX_LIMIT users by ID
+      - after (optional): ID of the last user of the previous page
+      - stream (optional): 1 to stream the array as it is built
     Return:
-      - list of all User objects JSON represented
+      - list of all User objects JSON represented, or of one page with
+        a Link header and X-Next-Cursor to the next page if any
+      - 400 if limit is not a number between 1 and MAX_LIMIT
+      - 304 if If-None-Match has the ETag of the current users
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    paged = limit is not None or after is not None
+    if paged:
+        try:
+            limit = int(limit or MAX_LIMIT)
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= MAX_LIMIT:
+            return jsonify({'error': "Wrong limit"}), 400
+    etag = make_etag('users', User.class_version())
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    next_cursor = None
+    if not paged:
+        users = User.iter_search()
+    else:
+        attributes = {} if after is None else {'id': After(after)}
+        users = User.search(attributes, limit=limit + 1, order_by='id')
+        if len(users) > limit:
+            users = users[:limit]
+            next_cursor = users[-1].id
+    if request.args.get('stream') == '1':
+        response = Response(stream_json(users), mimetype='application/json')
+    else:
+        response = Response(b"".join(stream_json(users)),
+                            mimetype='application/json')
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = '<{}>; rel="next"'.format(url_for(
+            'app_views.view_all_users', limit=limit, after=next_cursor,
+            stream=request.args.get('stream')))
+    response.set_etag(etag)
+    return response
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
@@ -24,17 +99,25 @@ def view_one_user(user_id: str = None) -> str:
     Return:
       - User object JSON represented
       - 404 if the User ID doesn't exist
+      - 304 if If-None-Match has the ETag of the current User
     """
     if user_id is None:
         abort(404)
     if user_id == 'me':
         if not request.current_user:
             abort(404)
-        return request.current_user.to_json()
-    user = User.get(user_id)
+        user = request.current_user
+    else:
+        user = User.get(user_id)
     if user is None:
         abort(404)
-    return jsonify(user.to_json())
+    etag = make_etag(user.id, user.version)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    response = jsonify(user.to_json())
+    response.set_etag(etag)
+    return response
 
 
 @app_views.route('/users/<user_id>', methods=['DELETE'], strict_slashes=False)
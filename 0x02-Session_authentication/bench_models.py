@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+""" Benchmark of the models file store
+
+usage: ./bench_models.py [COUNT]
+       ./bench_models.py codecs [COUNT ...]
+       ./bench_models.py threads [COUNT]
+       ./bench_models.py listing [COUNT]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from models.codec import CODECS
+from models.user import User
+from models.user_session import UserSession
+import models.base as base
+
+
+def make_users(count: int) -> list:
+    """ Return count users as loaded from a file
+    """
+    user = User(email="bob@hbtn.io", first_name="Bob", last_name="Dylan")
+    user.password = "H0lbertonSchool98!"
+    obj_json = user.to_json(True)
+    return [User(**dict(obj_json, id=str(i))) for i in range(count)]
+
+
+def bench_memory(count: int):
+    """ Print the memory retained per User and per UserSession
+    """
+    for name, make in (
+        ("User", lambda: make_users(count)),
+        ("UserSession", lambda: [UserSession(user_id="u", session_id=str(i))
+                                 for i in range(count)]),
+    ):
+        gc.collect()
+        tracemalloc.start()
+        objs = make()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("{:<28} {:>10.0f} bytes/object".format(
+            name + " memory", size / len(objs)))
+        del objs
+
+
+def bench_to_json(count: int):
+    """ Print the throughput of building and serializing users
+    """
+    start = time.perf_counter()
+    users = make_users(count)
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>10.0f} objects/s".format("User(**json)", count / elapsed))
+    for for_serialization in (False, True):
+        start = time.perf_counter()
+        for user in users:
+            user.to_json(for_serialization)
+        elapsed = time.perf_counter() - start
+        print("{:<28} {:>10.0f} objects/s".format(
+            "to_json({})".format(for_serialization), count / elapsed))
+
+
+def bench_codecs(count: int):
+    """ Print the save and load time and the file size of each codec
+    """
+    obj_json = make_users(1)[0].to_json(True)
+    objs_json = {str(i): dict(obj_json, id=str(i)) for i in range(count)}
+    for name, codec in CODECS.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "db")
+            start = time.perf_counter()
+            with open(file_path, 'wb' if codec.binary else 'w') as f:
+                codec.dump(objs_json, f)
+            saved = time.perf_counter() - start
+            start = time.perf_counter()
+            with open(file_path, 'rb' if codec.binary else 'r') as f:
+                loaded = dict(codec.load(f))
+            elapsed = time.perf_counter() - start
+            assert len(loaded) == count
+            print("{:>8} {:<8} save {:7.3f}s  load {:7.3f}s  {:>6.1f} MB"
+                  .format(count, name, saved, elapsed,
+                          os.path.getsize(file_path) / 2 ** 20))
+
+
+def bench_listing(count: int, rounds: int = 3):
+    """ Print the time to encode a listing of users as the users view
+    does, uncached, then with to_json cached, then with cached bytes as
+    with BASE_JSON_BYTES_CACHE=1
+    """
+    users = make_users(count)
+    bytes_cache = base.JSON_BYTES_CACHE
+
+    def uncached():
+        return json.dumps([user._to_json(False) for user in users],
+                          sort_keys=True, separators=(',', ':'))
+
+    def cached_dicts():
+        return json.dumps([user.to_json() for user in users],
+                          sort_keys=True, separators=(',', ':'))
+
+    def cached_bytes():
+        return b"[" + b",".join(user.to_json_bytes() for user in users) \
+            + b"]"
+
+    for name, listing in (("uncached to_json", uncached),
+                          ("cached to_json", cached_dicts),
+                          ("cached JSON bytes", cached_bytes)):
+        base.JSON_BYTES_CACHE = listing is cached_bytes
+        listing()
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            listing()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("{:>8} {:<20} {:8.1f} ms".format(count, name, best * 1000))
+    base.JSON_BYTES_CACHE = bytes_cache
+
+
+def stress(ops: int, count: int, seed: int, batched: bool = True) -> int:
+    """ Run a mix of lookups, email searches and saves on the users,
+    in one batch or each save writing the file, returns the number of
+    operations run
+    """
+    rand = random.Random(seed)
+    with User.batch() if batched else nullcontext():
+        for _ in range(ops):
+            op = rand.random()
+            user_id = str(rand.randrange(count))
+            if op < 0.9:
+                User.get(user_id)
+            elif op < 0.98:
+                User.search({'email': "{}@hbtn.io".format(user_id)})
+            else:
+                User.get(user_id).save()
+    return ops
+
+
+def bench_threads(count: int, ops: int = 200000):
+    """ Print the throughput of concurrent registry access by number of
+    threads, writes being batched per thread, then written on each save
+    with a twentieth of the operations
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            with User.batch():
+                for user in make_users(count):
+                    user.email = "{}@hbtn.io".format(user.id)
+                    user.save()
+            for batched, total in ((True, ops), (False, ops // 20)):
+                for threads in (1, 2, 4, 8):
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(threads) as executor:
+                        done = sum(executor.map(
+                            stress, [total // threads] * threads,
+                            [count] * threads, range(threads),
+                            [batched] * threads))
+                    elapsed = time.perf_counter() - start
+                    assert User.count() == count
+                    print("{:>9} {:>2} threads {:>12.0f} ops/s".format(
+                        "batched" if batched else "unbatched", threads,
+                        done / elapsed))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["codecs"]:
+        for count in sys.argv[2:] or (10000, 100000, 1000000):
+            bench_codecs(int(count))
+        sys.exit()
+    if sys.argv[1:2] == ["listing"]:
+        bench_listing(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+        sys.exit()
+    if sys.argv[1:2] == ["threads"]:
+        bench_threads(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+        sys.exit()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bench_memory(min(count, 10000))
+    bench_to_json(count)
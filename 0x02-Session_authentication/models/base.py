@@ -1,21 +1,109 @@
 #!/usr/bin/env python3
 """ Base module
 """
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from typing import TypeVar, List, Iterable, Iterator, Callable, IO
+from models.codec import JSONCodec, codec_for, shard_of, shard_paths
+from models.codec import file_path as codec_file_path
+from models.engine import engine_for
+from models.flush import dirty_ids, flush_dirty, mark_dirty, take_dirty
+from models.index import Index, IdIndex
+from models.journal import COMPACT_LOCK, COMPACTING, JOURNAL_LOCK
+from models.journal import append, drop_journal, lock_file, replay, rotate
+from models.lazy import LazyObjects
+from models.query import ANY, matches, ordering, sort_key
+from models.shard import ShardIndex, check_layout, read_shards
+from itertools import islice
+from os import getenv, path
+import atexit
+import fcntl
 import json
+import os
+import threading
 import uuid
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATA = {}
+INDEXES = {}
+STORAGE = getenv('BASE_STORAGE', 'file')
+JOURNAL_MAX_BYTES = int(getenv('BASE_JOURNAL_MAX_BYTES', 1024 * 1024))
+FSYNC = getenv('BASE_FSYNC', '0') == '1'
+BATCH = threading.local()
+BATCHES = 0
+FLUSH_POLICY = getenv('BASE_FLUSH_POLICY', 'write')
+FLUSH_INTERVAL = float(getenv('BASE_FLUSH_INTERVAL', 1.0))
+FLUSH_THRESHOLD = int(getenv('BASE_FLUSH_THRESHOLD', 100))
+LAZY_LOAD = getenv('BASE_LAZY_LOAD', '0') == '1'
+JSON_BYTES_CACHE = getenv('BASE_JSON_BYTES_CACHE', '0') == '1'
+FIELDS = {}
+SHARDS = int(getenv('BASE_SHARDS', 1))
+LOCKS = {}
+FILE_LOCKS = {}
+STATES = {}
+VERSIONS = {}
+STORE_ID = uuid.uuid4().hex[:12]
+ENGINE = engine_for(getenv('BASE_ENGINE', 'file'), FSYNC)
+LOCKS_LOCK = threading.Lock()
+
+
+def write_atomic(file_path: str, dump: Callable[[IO], None],
+                 binary: bool = False):
+    """ Replace the content of a file so that it is never seen half written
+    """
+    tmp_path = "{}.{}.tmp".format(file_path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb' if binary else 'w') as f:
+        dump(f)
+        if FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def file_state(file_path: str) -> tuple:
+    """ Return the inode, modification time and size of a file, None if
+    it does not exist: together they change whenever it is rewritten
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def version_scope() -> str:
+    """ Return what class versions are counted in: the database of the
+    storage engine, or this process for the file store
+    """
+    if ENGINE is not None:
+        return ENGINE.scope()
+    return STORE_ID
+
+
+def parse_timestamp(value: str) -> datetime:
+    """ Parse a TIMESTAMP_FORMAT string
+    """
+    return datetime.fromisoformat(value)
+
+
+def format_timestamp(value: datetime) -> str:
+    """ Format a datetime as a TIMESTAMP_FORMAT string
+    """
+    return value.isoformat(timespec='seconds')
+
+
+if FLUSH_POLICY != 'write':
+    atexit.register(flush_dirty)
 
 
 class Base():
     """ Base class
     """
 
+    __slots__ = ('id', 'created_at', 'updated_at', '_version', '_cache')
+    INDEXED = ()
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
@@ -25,15 +113,20 @@ class Base():
 
         self.id = kwargs.get('id', str(uuid.uuid4()))
         if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+            self.created_at = parse_timestamp(kwargs.get('created_at'))
         else:
             self.created_at = datetime.utcnow()
         if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+            self.updated_at = parse_timestamp(kwargs.get('updated_at'))
         else:
             self.updated_at = datetime.utcnow()
+        self._version = kwargs.get('_version') or 0
+
+    @property
+    def version(self) -> int:
+        """ Number of times the object was saved or removed
+        """
+        return self._version
 
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
@@ -44,70 +137,574 @@ class Base():
             return False
         return (self.id == other.id)
 
+    def __setattr__(self, name: str, value, _set=object.__setattr__):
+        """ Set an attribute, forgetting the cached serializations and
+        re-indexing a stored object at once
+        """
+        if BATCHES and getattr(BATCH, 'undo', None) is not None:
+            self._remember(getattr(self, 'id', None), self)
+        _set(self, name, value)
+        _set(self, '_cache', None)
+        if name in self.INDEXED:
+            self._reindex(name)
+
+    def _reindex(self, name: str):
+        """ Update the index on name with this object, if it is the one
+        stored under its ID
+        """
+        s_class = self.__class__.__name__
+        index = INDEXES.get(s_class, {}).get(name)
+        objs = DATA.get(s_class)
+        if index is None or objs is None:
+            return
+        if isinstance(objs, LazyObjects):
+            objs = objs.entries
+        obj_id = getattr(self, 'id', None)
+        if objs.get(obj_id) is not self:
+            return
+        with self._lock():
+            if objs.get(obj_id) is self:
+                index.add(self)
+
+    @classmethod
+    def _fields(cls) -> tuple:
+        """ Return the slot names of the class, base classes first
+        """
+        fields = FIELDS.get(cls)
+        if fields is None:
+            fields = tuple(
+                name
+                for klass in reversed(cls.__mro__)
+                for name in klass.__dict__.get('__slots__', ())
+                if name not in ('__dict__', '__weakref__', '_cache')
+            )
+            FIELDS[cls] = fields
+        return fields
+
     def to_json(self, for_serialization: bool = False) -> dict:
-        """ Convert the object a JSON dictionary
+        """ Convert the object a JSON dictionary, cached until an
+        attribute is set
+        """
+        cache = self._cached()
+        result = cache.get(for_serialization)
+        if result is None:
+            result = self._to_json(for_serialization)
+            cache[for_serialization] = result
+        return dict(result)
+
+    def to_json_bytes(self) -> bytes:
+        """ Return the public JSON dictionary encoded as jsonify sends it,
+        with sorted keys and no spaces, cached like to_json if
+        JSON_BYTES_CACHE is set
+        """
+        cache = self._cached() if JSON_BYTES_CACHE else {}
+        encoded = cache.get('bytes')
+        if encoded is None:
+            encoded = json.dumps(self.to_json(), sort_keys=True,
+                                 separators=(',', ':')).encode()
+            cache['bytes'] = encoded
+        return encoded
+
+    def _cached(self) -> dict:
+        """ Return the serializations cached since the last attribute set
+        """
+        cache = getattr(self, '_cache', None)
+        if cache is None:
+            cache = {}
+            object.__setattr__(self, '_cache', cache)
+        return cache
+
+    def _to_json(self, for_serialization: bool) -> dict:
+        """ Build the JSON dictionary of to_json
         """
         result = {}
-        for key, value in self.__dict__.items():
+        for key in self._fields():
+            if not for_serialization and key[0] == '_':
+                continue
+            value = getattr(self, key, self)
+            if value is self:
+                continue
+            if type(value) is datetime:
+                value = format_timestamp(value)
+            result[key] = value
+        for key, value in getattr(self, '__dict__', {}).items():
             if not for_serialization and key[0] == '_':
                 continue
             if type(value) is datetime:
-                result[key] = value.strftime(TIMESTAMP_FORMAT)
-            else:
-                result[key] = value
+                value = format_timestamp(value)
+            result[key] = value
         return result
 
+    @classmethod
+    def file_path(cls, extension: str = None, shard: int = None) -> str:
+        """ Return the path of a storage file of the class, by default
+        the one its codec reads and writes
+        """
+        if extension is None:
+            extension = codec_for(cls.__name__).extension
+        return codec_file_path(cls.__name__, extension, shard)
+
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from file, then the journals and the changes
+        not flushed yet
         """
-        s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
+        if ENGINE is not None:
+            ENGINE.open(cls)
             return
+        s_class = cls.__name__
+        codec = codec_for(s_class)
+        file_path = cls.file_path()
+        check_layout(s_class, codec, SHARDS)
+        objs = {}
+        indexes = None
+        lazy = LAZY_LOAD and isinstance(codec, JSONCodec) and SHARDS == 1
+        compacting = COMPACT_LOCK if STORAGE == 'journal' else nullcontext()
+        with cls._file_lock(), compacting, cls._lock_file(fcntl.LOCK_SH), \
+                cls._lock():
+            pending = cls._pending()
+            files = cls._file_states()
+            journal_path = cls.file_path('journal')
+            journal = file_state(journal_path)
+            end = 0
+            if path.exists(file_path) and lazy:
+                objs = LazyObjects(cls, file_path)
+                indexes = objs.indexes
+            elif SHARDS > 1:
+                for obj_id, obj_json in read_shards(s_class, codec, SHARDS):
+                    objs[obj_id] = cls(**obj_json)
+            elif path.exists(file_path):
+                with open(file_path, 'rb' if codec.binary else 'r') as f:
+                    for obj_id, obj_json in codec.load(f):
+                        objs[obj_id] = cls(**obj_json)
+            if STORAGE == 'journal':
+                with JOURNAL_LOCK:
+                    drop_journal(s_class, journal[0] if journal else None)
+                    cls._replay(objs, indexes or {},
+                                cls.file_path('journal.old'))
+                    end = cls._replay(objs, indexes or {}, journal_path)
+            cls._apply(objs, indexes or {}, pending)
+            INDEXES.pop(s_class, None)
+            DATA[s_class] = objs
+            if indexes is not None:
+                INDEXES[s_class] = indexes
+            cls._bump()
+            STATES[s_class] = {
+                'files': files,
+                'journal': (journal[0] if journal else None, end),
+            }
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def refresh_if_changed(cls) -> bool:
+        """ Reload the class if its files changed since it was loaded,
+        returns whether anything was read
+        """
+        if ENGINE is not None:
+            return False
+        s_class = cls.__name__
+        state = STATES.get(s_class)
+        if state is None or cls._file_states() != state['files']:
+            cls.load_from_file()
+            return True
+        if STORAGE != 'journal':
+            return False
+        journal_path = cls.file_path('journal')
+        with cls._lock():
+            state = STATES[s_class]
+            ino, offset = state['journal']
+            journal = file_state(journal_path)
+            if journal is None and ino is None:
+                return False
+            rotated = journal is None or journal[2] < offset \
+                or ino is not None and journal[0] != ino
+            if not rotated:
+                if journal[2] == offset:
+                    return False
+                pending = cls._pending()
+                indexes = INDEXES.get(s_class, {})
+                end = cls._replay(DATA[s_class], indexes, journal_path,
+                                  offset, False)
+                cls._apply(DATA[s_class], indexes, pending)
+                state['journal'] = (journal[0], end)
+                if end > offset:
+                    cls._bump()
+                return end > offset
+        cls.load_from_file()
+        return True
+
+    @classmethod
+    def _pending(cls, changed: Iterable[str] = ()) -> dict:
+        """ Return the objects changed since the last flush by ID, and
+        those of changed, None for those removed
+        """
+        ids = dirty_ids(cls.__name__)
+        ids.update(changed)
+        objs = DATA.get(cls.__name__, {})
+        return {obj_id: objs.get(obj_id) for obj_id in ids}
+
+    @staticmethod
+    def _apply(objs: dict, indexes: dict, changes: dict):
+        """ Put objects by ID in objs and their indexes, None meaning
+        removed
+        """
+        for obj_id, obj in changes.items():
+            if obj is not None:
+                objs[obj_id] = obj
+                for index in indexes.values():
+                    index.add(obj)
+            elif obj_id in objs:
+                del objs[obj_id]
+                for index in indexes.values():
+                    index.discard(obj_id)
+
+    @classmethod
+    def _file_states(cls) -> dict:
+        """ Return the state of the snapshot files of the class by path
+        """
+        s_class = cls.__name__
+        paths = shard_paths(s_class, codec_for(s_class).extension, SHARDS)
+        if STORAGE == 'journal':
+            paths.append(cls.file_path('journal.old'))
+        return {file_path: file_state(file_path) for file_path in paths}
+
+    @classmethod
+    def _replay(cls, objs: dict, indexes: dict, journal_path: str,
+                offset: int = 0, repair: bool = True) -> int:
+        """ Apply the records of a journal from offset, returns the offset
+        past the last record applied
+        """
+        return replay(cls, objs, indexes, journal_path, offset, repair)
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
         """
-        s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
+        cls._save()
+
+    @classmethod
+    def _save(cls, changed: Iterable[str] = ()):
+        """ Save all objects to file, the objects of the IDs changed, not
+        written anywhere yet, prevailing over the journals in journal mode
+        """
+        if ENGINE is not None:
+            return
+        if STORAGE == 'journal':
+            cls._compact(changed)
+            return
+        with cls._file_lock():
+            cls._write(cls._serialize(cls._snapshot()))
+
+    @classmethod
+    def _snapshot(cls) -> list:
+        """ Return the (id, object) pairs of the class as they are now,
+        LazyEntry for objects never built
+        """
+        objs = DATA[cls.__name__]
+        if isinstance(objs, LazyObjects):
+            return list(objs.entries.items())
+        return list(objs.items())
+
+    @staticmethod
+    def _serialize(snapshot: list) -> dict:
+        """ Return the file content of a snapshot
+        """
         objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        for obj_id, obj in snapshot:
+            objs_json[obj_id] = obj._to_json(True) \
+                if isinstance(obj, Base) else obj.to_json()
+        return objs_json
+
+    @classmethod
+    def _write(cls, objs_json: dict, shard: int = None):
+        """ Replace the file of the class, or of its shards, with
+        serialized objects by ID
+        """
+        codec = codec_for(cls.__name__)
+        if SHARDS > 1 and shard is None:
+            shards = [{} for _ in range(SHARDS)]
+            for obj_id, obj_json in objs_json.items():
+                shards[shard_of(obj_id, SHARDS)][obj_id] = obj_json
+            for shard, shard_json in enumerate(shards):
+                cls._write(shard_json, shard)
+            return
+        file_path = cls.file_path(shard=shard)
+        write_atomic(file_path, lambda f: codec.dump(objs_json, f),
+                     codec.binary)
+        state = STATES.get(cls.__name__)
+        if state is not None:
+            state['files'][file_path] = file_state(file_path)
+
+    @classmethod
+    def _write_shard(cls, shard: int):
+        """ Rewrite the file of one shard of the class, from the IDs its
+        index holds for it
+        """
+        with cls._file_lock():
+            objs = DATA[cls.__name__]
+            members = cls._indexes()['_shard'].members(shard)
+            snapshot = [(obj_id, objs.get(obj_id)) for obj_id in members]
+            cls._write(cls._serialize(
+                [(obj_id, obj) for obj_id, obj in snapshot
+                 if obj is not None]), shard)
+
+    @classmethod
+    def _append(cls, op: str, obj_id: str, obj: TypeVar('Base') = None):
+        """ Append one mutation to the journal of the class
+        """
+        s_class = cls.__name__
+        record = {'op': op, 'id': obj_id}
+        if obj is not None:
+            record['obj'] = obj._to_json(True)
+        line = json.dumps(record) + "\n"
+        with JOURNAL_LOCK:
+            ino, start, end = append(s_class, cls.file_path('journal'),
+                                     line, FSYNC)
+            cls._advance(ino, start, end)
+            if end >= JOURNAL_MAX_BYTES and s_class not in COMPACTING:
+                COMPACTING.add(s_class)
+                threading.Thread(target=cls._compact, daemon=True).start()
+
+    @classmethod
+    def _advance(cls, ino: int, start: int, end: int):
+        """ Move the journal offset read by refresh_if_changed past a
+        record this process appended, if it was up to there
+        """
+        state = STATES.get(cls.__name__)
+        if state is None:
+            return
+        state_ino, offset = state['journal']
+        if offset == start and state_ino in (None, ino):
+            state['journal'] = (ino, end)
+
+    @classmethod
+    def _compact(cls, changed: Iterable[str] = ()):
+        """ Fold the journals of all processes into a new snapshot, over
+        which the objects of changed and the dirty ones are put back
+        """
+        s_class = cls.__name__
+        old_path = cls.file_path('journal.old')
+        journal_path = cls.file_path('journal')
+        try:
+            with cls._file_lock(), COMPACT_LOCK, \
+                    cls._lock_file(fcntl.LOCK_EX):
+                COMPACTING.add(s_class)
+                with cls._lock():
+                    pending = cls._pending(changed)
+                state = STATES.get(s_class)
+                if state is None or cls._file_states() != state['files']:
+                    cls.load_from_file()
+                with cls._lock(), JOURNAL_LOCK:
+                    cls._rotate(journal_path, old_path)
+                    cls._apply(DATA[s_class], INDEXES.get(s_class, {}),
+                               pending)
+                    state = STATES[s_class]
+                    state['journal'] = (None, 0)
+                    state['files'][old_path] = file_state(old_path)
+                    snapshot = cls._snapshot()
+                cls._write(cls._serialize(snapshot))
+                if path.exists(old_path):
+                    os.remove(old_path)
+                state['files'][old_path] = None
+        finally:
+            COMPACTING.discard(s_class)
+
+    @classmethod
+    def _rotate(cls, journal_path: str, old_path: str):
+        """ Set the journal aside as journal.old once the records not read
+        yet are replayed, holding the class lock
+        """
+        s_class = cls.__name__
+        ino, offset = STATES[s_class]['journal']
+        rotate(s_class, journal_path, old_path, lambda current: cls._replay(
+            DATA[s_class], INDEXES.get(s_class, {}), journal_path,
+            offset if current == ino else 0, False))
+
+    @classmethod
+    def _lock_file(cls, operation: int):
+        """ Return the lock file of the journals of the class, in journal
+        mode and with COMPACT_LOCK held
+        """
+        if STORAGE != 'journal':
+            return nullcontext()
+        return lock_file(cls.__name__, cls.file_path('journal.lock'),
+                         operation)
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    @contextmanager
+    def batch(cls) -> Iterator[None]:
+        """ Group the saves and removes of the block, on this thread,
+        writing each touched class once, or undoing them if it raises
+        """
+        global BATCHES
+        if ENGINE is not None:
+            with ENGINE.transaction():
+                yield
+            return
+        if getattr(BATCH, 'classes', None) is not None:
+            yield
+            return
+        BATCH.classes = {}
+        BATCH.undo = {}
+        with LOCKS_LOCK:
+            BATCHES += 1
+        try:
+            yield
+        except BaseException:
+            classes, BATCH.classes = BATCH.classes, None
+            undo, BATCH.undo = BATCH.undo, None
+            for klass, prior in undo.items():
+                klass._restore(prior)
+            for klass in set(undo) | set(classes.values()):
+                klass._save()
+            raise
+        finally:
+            with LOCKS_LOCK:
+                BATCHES -= 1
+        classes, BATCH.classes = BATCH.classes, None
+        undo, BATCH.undo = BATCH.undo, None
+        for klass in classes.values():
+            klass._save(undo.get(klass, ()))
+
+    @classmethod
+    def _remember(cls, obj_id: str, only: TypeVar('Base') = None):
+        """ Keep the stored state of an object before its first change in
+        the batch of this thread, if only is None or the object stored
+        """
+        undo = getattr(BATCH, 'undo', None)
+        if undo is None or obj_id is None:
+            return
+        prior = undo.get(cls)
+        if prior is not None and obj_id in prior:
+            return
+        objs = DATA.get(cls.__name__)
+        if objs is None:
+            return
+        if isinstance(objs, LazyObjects):
+            objs = objs.entries
+        obj = objs.get(obj_id)
+        if only is not None and obj is not only:
+            return
+        if isinstance(obj, Base):
+            obj = obj._to_json(True)
+        elif obj is not None:
+            obj = obj.to_json()
+        undo.setdefault(cls, {})[obj_id] = obj
+
+    @classmethod
+    def _restore(cls, prior: dict):
+        """ Put objects back as serialized by ID, None meaning removed
+        """
+        s_class = cls.__name__
+        with cls._lock():
+            cls._apply(DATA[s_class], INDEXES.get(s_class, {}), {
+                obj_id: None if obj_json is None else cls(**obj_json)
+                for obj_id, obj_json in prior.items()
+            })
+            cls._bump()
+
+    @classmethod
+    def _mark_dirty(cls, obj_id: str):
+        """ Leave the class to be written by the next flush
+        """
+        interval = FLUSH_INTERVAL if FLUSH_POLICY == 'interval' else None
+        mark_dirty(cls, obj_id, interval, FLUSH_THRESHOLD)
+
+    @classmethod
+    def _flush_if_dirty(cls):
+        """ Write the class now if it has unsaved changes, holding the
+        file lock from taking them until they are written
+        """
+        with cls._file_lock():
+            changed = take_dirty(cls.__name__)
+            if changed is not None:
+                cls._save(changed)
+
+    @classmethod
+    def _store(cls, obj_id: str, obj: TypeVar('Base') = None):
+        """ Persist the change of one object, None meaning it was removed
+        """
+        classes = getattr(BATCH, 'classes', None)
+        if classes is not None:
+            classes[cls.__name__] = cls
+            return
+        if FLUSH_POLICY != 'write':
+            cls._mark_dirty(obj_id)
+            return
+        if STORAGE == 'journal':
+            if obj is None:
+                cls._append('remove', obj_id)
+            else:
+                cls._append('save', obj_id, obj)
+        elif SHARDS > 1:
+            cls._write_shard(shard_of(obj_id, SHARDS))
+        else:
+            cls.save_to_file()
 
     def save(self):
         """ Save current object
         """
         s_class = self.__class__.__name__
+        if ENGINE is None:
+            self._remember(self.id)
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        if ENGINE is not None:
+            ENGINE.save(self)
+            return
+        self._version += 1
+        with self._lock():
+            DATA[s_class][self.id] = self
+            self._index()
+            self._bump()
+            if STORAGE == 'journal' or FLUSH_POLICY != 'write':
+                self._store(self.id, self)
+                return
+        self._store(self.id, self)
 
     def remove(self):
         """ Remove object
         """
+        if ENGINE is None:
+            self._remember(self.id)
+        self._version += 1
+        if ENGINE is not None:
+            ENGINE.remove(self)
+            return
         s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
+        with self._lock():
+            if self.id not in DATA[s_class]:
+                return
             del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+            self._unindex(self.id)
+            self._bump()
+            if STORAGE == 'journal' or FLUSH_POLICY != 'write':
+                self._store(self.id)
+                return
+        self._store(self.id)
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
+        if ENGINE is not None:
+            return ENGINE.count(cls)
         s_class = cls.__name__
         return len(DATA[s_class].keys())
 
+    @classmethod
+    def class_version(cls) -> int:
+        """ Return the number of changes made to the objects of the class,
+        counted by version_scope()
+        """
+        if ENGINE is not None:
+            return ENGINE.version(cls)
+        return VERSIONS.get(cls.__name__, 0)
+
+    @classmethod
+    def _bump(cls):
+        """ Increase the version of the class, holding its lock
+        """
+        VERSIONS[cls.__name__] = VERSIONS.get(cls.__name__, 0) + 1
+
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
         """ Return all objects
@@ -118,20 +715,123 @@ class Base():
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
+        if ENGINE is not None:
+            return ENGINE.get(cls, id)
         s_class = cls.__name__
         return DATA[s_class].get(id)
 
     @classmethod
-    def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
-        """ Search all objects with matching attributes
+    def _lock(cls) -> threading.RLock:
+        """ Return the lock serializing the changes to the class in DATA;
+        readers take none
+        """
+        lock = LOCKS.get(cls.__name__)
+        if lock is None:
+            with LOCKS_LOCK:
+                lock = LOCKS.setdefault(cls.__name__, threading.RLock())
+        return lock
+
+    @classmethod
+    def _file_lock(cls) -> threading.RLock:
+        """ Return the lock serializing the file writes of the class, taken
+        before COMPACT_LOCK and the lock of the class
+        """
+        lock = FILE_LOCKS.get(cls.__name__)
+        if lock is None:
+            with LOCKS_LOCK:
+                lock = FILE_LOCKS.setdefault(cls.__name__, threading.RLock())
+        return lock
+
+    @classmethod
+    def _indexes(cls) -> dict:
+        """ Return the indexes of the class by attribute, built on demand
         """
         s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
+        indexes = INDEXES.get(s_class)
+        if indexes is not None:
+            return indexes
+        with cls._lock():
+            if INDEXES.get(s_class) is None:
+                indexes = cls._new_indexes()
+                for obj in DATA.get(s_class, {}).values():
+                    for index in indexes.values():
+                        index.add(obj)
+                INDEXES[s_class] = indexes
+            return INDEXES[s_class]
+
+    @classmethod
+    def _new_indexes(cls) -> dict:
+        """ Return empty indexes of the class by attribute
+        """
+        indexes = {'id': IdIndex()}
+        if SHARDS > 1:
+            indexes['_shard'] = ShardIndex(SHARDS)
+        for attribute in cls.INDEXED:
+            indexes[attribute] = Index(attribute)
+        return indexes
+
+    def _index(self):
+        """ Update the built indexes of the class with this object
+        """
+        for index in INDEXES.get(self.__class__.__name__, {}).values():
+            index.add(self)
+
+    @classmethod
+    def _unindex(cls, obj_id: str):
+        """ Remove an object ID from the built indexes of the class
+        """
+        for index in INDEXES.get(cls.__name__, {}).values():
+            index.discard(obj_id)
+
+    @classmethod
+    def search(cls, attributes: dict = {}, limit: int = None,
+               offset: int = 0, order_by: str = None
+               ) -> List[TypeVar('Base')]:
+        """ Search all objects with matching attributes, see iter_search
+        """
+        return list(cls.iter_search(attributes, limit, offset, order_by))
+
+    @classmethod
+    def iter_search(cls, attributes: dict = {}, limit: int = None,
+                    offset: int = 0, order_by: str = None
+                    ) -> Iterator[TypeVar('Base')]:
+        """ Yield the objects with matching attributes, one at a time
+
+        An attribute matches by equality or a Prefix, In or After
+        predicate. order_by names an attribute, '-' first for descending
+        order. An indexed order_by is read in order, without sorting.
+        """
+        if ENGINE is not None:
+            yield from ENGINE.iter_search(cls, {
+                k: format_timestamp(v) if type(v) is datetime else v
+                for k, v in attributes.items()
+            }, limit, offset, order_by)
+            return
+        objs = DATA[cls.__name__]
+        indexes = cls._indexes()
+        key, reverse = ordering(order_by) if order_by else (None, False)
+        if key in indexes:
+            ids = indexes[key].ids(attributes.get(key, ANY), reverse)
+            candidates = (objs.get(i) for i in ids)
+        else:
             for k, v in attributes.items():
-                if (getattr(obj, k) != v):
-                    return False
-            return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+                if k in indexes:
+                    candidates = [objs.get(i) for i in indexes[k].ids(v)]
+                    break
+            else:
+                if isinstance(objs, LazyObjects):
+                    candidates = [objs.get(i) for i in objs]
+                else:
+                    candidates = list(objs.values())
+            if key is not None:
+                candidates = sorted(
+                    (obj for obj in candidates if obj is not None),
+                    key=lambda obj: sort_key(getattr(obj, key, None)),
+                    reverse=reverse)
+        matched = (
+            obj for obj in candidates
+            if obj is not None and all(
+                matches(getattr(obj, k), v) for k, v in attributes.items())
+        )
+        stop = None if limit is None else offset + limit
+        yield from islice(matched, offset, stop)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+""" Codec module: file formats of the Base file store
+
+usage: python3 -m models.codec CLASS SOURCE_CODEC TARGET_CODEC
+       python3 -m models.codec reshard CLASS OLD_SHARDS NEW_SHARDS
+"""
+from abc import ABC, abstractmethod
+from os import getenv, path
+from typing import IO, Iterator, Tuple
+import glob
+import json
+import marshal
+import os
+import struct
+import sys
+import zlib
+
+
+class Codec(ABC):
+    """ Format of the file holding the objects of a class
+    """
+
+    name = None
+    extension = None
+    binary = False
+
+    @abstractmethod
+    def dump(self, objs_json: dict, f: IO):
+        """ Write serialized objects by ID to a file
+        """
+
+    @abstractmethod
+    def load(self, f: IO) -> Iterator[Tuple[str, dict]]:
+        """ Yield (id, serialized object) pairs read from a file
+        """
+
+
+class JSONCodec(Codec):
+    """ One JSON object of serialized objects by ID, the original format
+    """
+
+    name = 'json'
+    extension = 'json'
+
+    def dump(self, objs_json: dict, f: IO):
+        """ Write serialized objects by ID to a file
+        """
+        json.dump(objs_json, f)
+
+    def load(self, f: IO) -> Iterator[Tuple[str, dict]]:
+        """ Yield (id, serialized object) pairs read from a file
+        """
+        return iter(json.load(f).items())
+
+
+class NDJSONCodec(Codec):
+    """ One serialized object per line, read and written as a stream
+    """
+
+    name = 'ndjson'
+    extension = 'ndjson'
+
+    def dump(self, objs_json: dict, f: IO):
+        """ Write serialized objects by ID to a file
+        """
+        for obj_json in objs_json.values():
+            f.write(json.dumps(obj_json))
+            f.write("\n")
+
+    def load(self, f: IO) -> Iterator[Tuple[str, dict]]:
+        """ Yield (id, serialized object) pairs read from a file
+        """
+        for line in f:
+            if line.strip():
+                obj_json = json.loads(line)
+                yield obj_json['id'], obj_json
+
+
+class MarshalCodec(Codec):
+    """ Compact binary format: length-prefixed marshal records of CHUNK
+    objects each
+    """
+
+    name = 'marshal'
+    extension = 'marshal'
+    binary = True
+    CHUNK = 1000
+    HEADER = struct.Struct('<I')
+
+    def dump(self, objs_json: dict, f: IO):
+        """ Write serialized objects by ID to a file
+        """
+        values = list(objs_json.values())
+        for start in range(0, len(values), self.CHUNK):
+            record = marshal.dumps(values[start:start + self.CHUNK])
+            f.write(self.HEADER.pack(len(record)))
+            f.write(record)
+
+    def load(self, f: IO) -> Iterator[Tuple[str, dict]]:
+        """ Yield (id, serialized object) pairs read from a file
+        """
+        while True:
+            header = f.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                return
+            size, = self.HEADER.unpack(header)
+            for obj_json in marshal.loads(f.read(size)):
+                yield obj_json['id'], obj_json
+
+
+CODECS = {
+    codec.name: codec
+    for codec in (JSONCodec(), NDJSONCodec(), MarshalCodec())
+}
+
+
+def codec_for(s_class: str) -> Codec:
+    """ Return the codec of a class: BASE_CODEC_<CLASS> if set, else
+    BASE_CODEC, else JSON
+    """
+    name = getenv('BASE_CODEC_{}'.format(s_class.upper()),
+                  getenv('BASE_CODEC', JSONCodec.name))
+    if name not in CODECS:
+        raise ValueError("unknown codec: {}".format(name))
+    return CODECS[name]
+
+
+def file_path(s_class: str, extension: str, shard: int = None) -> str:
+    """ Return the path of the file of a class, or of one of its shards
+    """
+    if shard is None:
+        return ".db_{}.{}".format(s_class, extension)
+    return ".db_{}.{}.{}".format(s_class, shard, extension)
+
+
+def shard_of(obj_id: str, shards: int) -> int:
+    """ Return the shard an object ID belongs to
+    """
+    return zlib.crc32(obj_id.encode()) % shards
+
+
+def shard_paths(s_class: str, extension: str, shards: int) -> list:
+    """ Return the paths of the files of a class split in shards, a
+    single shard being the unsharded file
+    """
+    if shards == 1:
+        return [file_path(s_class, extension)]
+    return [file_path(s_class, extension, k) for k in range(shards)]
+
+
+def foreign_paths(s_class: str, extension: str) -> list:
+    """ Return the existing files of a class, sharded or not, written by
+    another codec than the one of extension
+    """
+    foreign = []
+    for codec in CODECS.values():
+        if codec.extension == extension:
+            continue
+        prefix, suffix = file_path(s_class, ''), "." + codec.extension
+        for other in glob.glob(glob.escape(prefix) + "*"
+                               + glob.escape(suffix)):
+            if other[len(prefix):-len(suffix)].isdigit():
+                foreign.append(other)
+        unsharded = file_path(s_class, codec.extension)
+        if path.exists(unsharded):
+            foreign.append(unsharded)
+    return sorted(foreign)
+
+
+def read(codec: Codec, file_path: str) -> list:
+    """ Return the (id, serialized object) pairs of a file, none if the
+    file does not exist
+    """
+    if not path.exists(file_path):
+        return []
+    with open(file_path, 'rb' if codec.binary else 'r') as f:
+        return list(codec.load(f))
+
+
+def convert(s_class: str, source: str, target: str) -> int:
+    """ Rewrite the file of a class from one codec to another, removing
+    the source file, returns the number of objects converted
+    """
+    source, target = CODECS[source], CODECS[target]
+    src_path = file_path(s_class, source.extension)
+    objs_json = dict(read(source, src_path))
+    dst_path = file_path(s_class, target.extension)
+    with open(dst_path, 'wb' if target.binary else 'w') as f:
+        target.dump(objs_json, f)
+    if src_path != dst_path and path.exists(src_path):
+        os.remove(src_path)
+    return len(objs_json)
+
+
+def reshard(s_class: str, old: int, new: int) -> int:
+    """ Redistribute the files of a class from old to new shards, offline,
+    returns the number of objects moved
+    """
+    codec = codec_for(s_class)
+    objs_json = {}
+    old_paths = shard_paths(s_class, codec.extension, old)
+    for old_path in old_paths:
+        objs_json.update(read(codec, old_path))
+    shards = [{} for _ in range(new)]
+    for obj_id, obj_json in objs_json.items():
+        shards[shard_of(obj_id, new)][obj_id] = obj_json
+    new_paths = shard_paths(s_class, codec.extension, new)
+    for new_path, shard in zip(new_paths, shards):
+        with open(new_path, 'wb' if codec.binary else 'w') as f:
+            codec.dump(shard, f)
+    for old_path in set(old_paths) - set(new_paths):
+        if path.exists(old_path):
+            os.remove(old_path)
+    return len(objs_json)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == 'reshard':
+        count = reshard(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        print("resharded {} {} objects".format(count, sys.argv[2]))
+    elif len(sys.argv) == 4:
+        count = convert(*sys.argv[1:])
+        print("converted {} {} objects".format(count, sys.argv[1]))
+    else:
+        sys.exit(__doc__.split("\n", 2)[2].strip())
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+""" Engine module: storage engines of the Base model API
+
+usage: python3 -m models.engine migrate [CLASS ...]
+"""
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from os import getenv
+from itertools import islice
+from typing import Iterable, Iterator, List, TypeVar
+from models.query import After, In, Prefix, matches, ordering, sort_key
+import random
+import sqlite3
+import sys
+import threading
+
+
+class Engine(ABC):
+    """ Storage of the objects of every class, in place of the in-memory
+    file store of Base
+    """
+
+    name = None
+
+    @abstractmethod
+    def open(self, cls: type):
+        """ Prepare the storage of a class
+        """
+
+    @abstractmethod
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or replace an object, setting its version to the next
+        one of the stored object
+        """
+
+    def save_all(self, objs: Iterable[TypeVar('Base')]) -> int:
+        """ Insert or replace objects of one class, returns their number
+        """
+        count = 0
+        with self.transaction():
+            for obj in objs:
+                self.save(obj)
+                count += 1
+        return count
+
+    @abstractmethod
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object
+        """
+
+    @abstractmethod
+    def get(self, cls: type, obj_id: str) -> TypeVar('Base'):
+        """ Return one object of a class by ID, None if there is none
+        """
+
+    def search(self, cls: type, attributes: dict, limit: int = None,
+               offset: int = 0, order_by: str = None
+               ) -> List[TypeVar('Base')]:
+        """ Return the objects of a class with matching serialized
+        attributes, as Base.search
+        """
+        return list(self.iter_search(cls, attributes, limit, offset,
+                                     order_by))
+
+    @abstractmethod
+    def iter_search(self, cls: type, attributes: dict, limit: int = None,
+                    offset: int = 0, order_by: str = None
+                    ) -> Iterator[TypeVar('Base')]:
+        """ Yield the objects of a class with matching serialized
+        attributes, as Base.iter_search
+        """
+
+    @abstractmethod
+    def count(self, cls: type) -> int:
+        """ Count the objects of a class
+        """
+
+    @abstractmethod
+    def version(self, cls: type) -> int:
+        """ Return the number of changes made to the objects of a class
+        """
+
+    @abstractmethod
+    def scope(self) -> str:
+        """ Return the name of the engine and the ID of its database,
+        which versions are counted in
+        """
+
+    def all(self, cls: type) -> List[TypeVar('Base')]:
+        """ Return all objects of a class
+        """
+        return self.search(cls, {})
+
+    @abstractmethod
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """ Apply the changes of the block all at once, or none of them
+        if it raises
+        """
+
+
+class SQLiteEngine(Engine):
+    """ One SQLite database with a table per class, a column per field
+    and an index per INDEXED attribute
+
+    Each thread has its own connection. The database runs in WAL mode,
+    so readers never wait for the writer, in other processes too. The
+    statements of a class are built once and reused, which keeps them
+    prepared in the statement cache of each connection. The version of
+    each class is a row of the _versions table, bumped in the
+    transaction of each change so that all processes share it, as are
+    the versions of the objects. The row of the empty class name holds
+    a random ID of the database.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, db_path: str, fsync: bool = False):
+        """ Initialize the engine of the database at db_path
+        """
+        self.db_path = db_path
+        self.fsync = fsync
+        self.local = threading.local()
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.database_id = None
+
+    def connection(self) -> sqlite3.Connection:
+        """ Return the connection of the current thread
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30,
+                                   isolation_level=None,
+                                   cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous={}".format(
+                "FULL" if self.fsync else "NORMAL"))
+            conn.execute('CREATE TABLE IF NOT EXISTS "_versions" '
+                         '("class" TEXT PRIMARY KEY NOT NULL, '
+                         '"version" INTEGER NOT NULL)')
+            conn.execute('INSERT OR IGNORE INTO "_versions" VALUES (\'\', ?)',
+                         (random.getrandbits(63),))
+            self.local.conn = conn
+        return conn
+
+    def open(self, cls: type) -> dict:
+        """ Create the table and indexes of a class if missing, adding
+        the columns of new fields, and return its statements
+        """
+        with self.lock:
+            statements = self.tables.get(cls)
+            if statements is not None:
+                return statements
+            table = cls.__name__
+            fields = cls._fields()
+            columns = ", ".join('"{}"'.format(f) for f in fields)
+            conn = self.connection()
+            conn.execute('CREATE TABLE IF NOT EXISTS "{}" '
+                         '("id" TEXT PRIMARY KEY NOT NULL)'.format(table))
+            existing = {row[1] for row in conn.execute(
+                'PRAGMA table_info("{}")'.format(table))}
+            for field in fields:
+                if field not in existing:
+                    conn.execute('ALTER TABLE "{}" ADD COLUMN "{}"'
+                                 .format(table, field))
+            for field in cls.INDEXED:
+                conn.execute('CREATE INDEX IF NOT EXISTS "{0}_{1}" '
+                             'ON "{0}" ("{1}")'.format(table, field))
+            statements = {
+                'fields': fields,
+                'save': 'INSERT INTO "{0}" ({1}) VALUES ({2}) '
+                        'ON CONFLICT ("id") DO UPDATE SET {3}, '
+                        '"_version" = COALESCE("{0}"."_version", 0) + 1 '
+                        'RETURNING "_version"'.format(
+                            table, columns, ", ".join("?" * len(fields)),
+                            ", ".join('"{0}" = excluded."{0}"'.format(f)
+                                      for f in fields
+                                      if f not in ('id', '_version'))),
+                'copy': 'INSERT OR REPLACE INTO "{}" ({}) VALUES ({})'.format(
+                    table, columns, ", ".join("?" * len(fields))),
+                'remove': 'DELETE FROM "{}" WHERE "id" = ?'.format(table),
+                'select': 'SELECT {} FROM "{}"'.format(columns, table),
+                'get': 'SELECT {} FROM "{}" WHERE "id" = ?'.format(
+                    columns, table),
+                'count': 'SELECT COUNT(*) FROM "{}"'.format(table),
+                'bump': 'INSERT INTO "_versions" VALUES (?, 1) '
+                        'ON CONFLICT ("class") '
+                        'DO UPDATE SET "version" = "version" + 1',
+                'version': 'SELECT "version" FROM "_versions" '
+                           'WHERE "class" = ?',
+            }
+            self.tables[cls] = statements
+            return statements
+
+    def statements(self, cls: type) -> dict:
+        """ Return the statements of a class, opening it on first use
+        """
+        statements = self.tables.get(cls)
+        if statements is None:
+            statements = self.open(cls)
+        return statements
+
+    def build(self, cls: type, fields: tuple, row: tuple) -> TypeVar('Base'):
+        """ Return the object of a row
+        """
+        return cls(**dict(zip(fields, row)))
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or replace an object, setting its version to the next
+        one of the stored object
+
+        The version is increased in SQL, so that concurrent saves of the
+        same object, from copies of it, never get the same version.
+        """
+        statements = self.statements(type(obj))
+        obj_json = obj._to_json(True)
+        obj_json['_version'] = 1
+        conn = self.connection()
+        with self.transaction():
+            version, = conn.execute(
+                statements['save'],
+                [obj_json.get(field) for field in statements['fields']]
+            ).fetchone()
+            conn.execute(statements['bump'], (type(obj).__name__,))
+        obj._version = version
+
+    def save_all(self, objs: Iterable[TypeVar('Base')]) -> int:
+        """ Insert or replace objects of one class as they are, versions
+        included, returns their number
+        """
+        objs = iter(objs)
+        first = next(objs, None)
+        if first is None:
+            return 0
+        statements = self.statements(type(first))
+        fields = statements['fields']
+        rows = [[first._to_json(True).get(f) for f in fields]]
+        rows.extend([obj._to_json(True).get(f) for f in fields]
+                    for obj in objs)
+        conn = self.connection()
+        with self.transaction():
+            conn.executemany(statements['copy'], rows)
+            conn.execute(statements['bump'], (type(first).__name__,))
+        return len(rows)
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object
+        """
+        statements = self.statements(type(obj))
+        conn = self.connection()
+        with self.transaction():
+            if conn.execute(statements['remove'], (obj.id,)).rowcount:
+                conn.execute(statements['bump'], (type(obj).__name__,))
+
+    def get(self, cls: type, obj_id: str) -> TypeVar('Base'):
+        """ Return one object of a class by ID, None if there is none
+        """
+        statements = self.statements(cls)
+        row = self.connection().execute(statements['get'],
+                                        (obj_id,)).fetchone()
+        if row is None:
+            return None
+        return self.build(cls, statements['fields'], row)
+
+    def iter_search(self, cls: type, attributes: dict, limit: int = None,
+                    offset: int = 0, order_by: str = None
+                    ) -> Iterator[TypeVar('Base')]:
+        """ Yield the objects of a class with matching serialized
+        attributes, as Base.iter_search
+
+        Fields are matched, ordered and paged in SQL, through their
+        index if any. Other attributes are matched on the objects built,
+        paging then being done on them as well.
+        """
+        statements = self.statements(cls)
+        fields = statements['fields']
+        where, params, others = [], [], {}
+        for k, v in attributes.items():
+            if k not in fields:
+                others[k] = v
+            elif v is None:
+                where.append('"{}" IS NULL'.format(k))
+            elif isinstance(v, After):
+                where.append('"{}" > ?'.format(k))
+                params.append(v.value)
+            elif isinstance(v, Prefix):
+                where.append('"{}" >= ?'.format(k))
+                params.append(v.prefix)
+                if v.upper() is not None:
+                    where.append('"{}" < ?'.format(k))
+                    params.append(v.upper())
+            elif isinstance(v, In):
+                values = [value for value in v.values if value is not None]
+                condition = '"{}" IN ({})'.format(
+                    k, ", ".join("?" * len(values)))
+                if None in v.values:
+                    condition = '({} OR "{}" IS NULL)'.format(condition, k)
+                where.append(condition)
+                params.extend(values)
+            else:
+                where.append('"{}" = ?'.format(k))
+                params.append(v)
+        sql = statements['select']
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        key, reverse = ordering(order_by) if order_by else (None, False)
+        if key in fields:
+            sql += ' ORDER BY "{}" {}'.format(
+                key, "DESC" if reverse else "ASC")
+        in_sql = not others and (key is None or key in fields)
+        if in_sql and (limit is not None or offset):
+            sql += " LIMIT ? OFFSET ?"
+            params += [-1 if limit is None else limit, offset]
+        objs = (self.build(cls, fields, row)
+                for row in self.connection().execute(sql, params))
+        if in_sql:
+            yield from objs
+            return
+        objs = (obj for obj in objs
+                if all(matches(getattr(obj, k, None), v)
+                       for k, v in others.items()))
+        if key is not None and key not in fields:
+            objs = sorted(objs, reverse=reverse,
+                          key=lambda obj: sort_key(getattr(obj, key, None)))
+        stop = None if limit is None else offset + limit
+        yield from islice(objs, offset, stop)
+
+    def count(self, cls: type) -> int:
+        """ Count the objects of a class
+        """
+        statements = self.statements(cls)
+        return self.connection().execute(statements['count']).fetchone()[0]
+
+    def version(self, cls: type) -> int:
+        """ Return the number of changes made to the objects of a class
+        """
+        statements = self.statements(cls)
+        row = self.connection().execute(statements['version'],
+                                        (cls.__name__,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def scope(self) -> str:
+        """ Return the name of the engine and the ID of its database,
+        which versions are counted in
+        """
+        if self.database_id is None:
+            row = self.connection().execute(
+                'SELECT "version" FROM "_versions" WHERE "class" = \'\''
+            ).fetchone()
+            self.database_id = "{:x}".format(row[0])
+        return "{}.{}".format(self.name, self.database_id)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """ Apply the changes of the block all at once, or none of them
+        if it raises; nested blocks join the outermost one
+        """
+        conn = self.connection()
+        if conn.in_transaction:
+            yield
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+ENGINES = {
+    SQLiteEngine.name: lambda fsync: SQLiteEngine(
+        getenv('BASE_SQLITE_PATH', '.db.sqlite3'), fsync),
+}
+
+
+def engine_for(name: str, fsync: bool = False) -> Engine:
+    """ Return a new engine by name, None for the file store of Base
+    """
+    if name == 'file':
+        return None
+    if name not in ENGINES:
+        raise ValueError("unknown engine: {}".format(name))
+    return ENGINES[name](fsync)
+
+
+def migrate(classes: Iterable[type], engine: Engine) -> dict:
+    """ Copy the objects of classes from their files to an engine,
+    returns the number of objects copied by class name
+    """
+    counts = {}
+    for cls in classes:
+        cls.load_from_file()
+        engine.open(cls)
+        counts[cls.__name__] = engine.save_all(cls.all())
+    return counts
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ['migrate']:
+        sys.exit(__doc__.split("\n", 2)[2].strip())
+    import models.base
+    from models.user import User
+    from models.user_session import UserSession
+
+    if models.base.ENGINE is not None:
+        sys.exit("unset BASE_ENGINE to read the files to migrate")
+    classes = {cls.__name__: cls for cls in (User, UserSession)}
+    names = sys.argv[2:] or list(classes)
+    unknown = set(names) - set(classes)
+    if unknown:
+        sys.exit("unknown class: {}".format(", ".join(sorted(unknown))))
+    engine = engine_for(SQLiteEngine.name, models.base.FSYNC)
+    counts = migrate([classes[name] for name in names], engine)
+    for name, count in counts.items():
+        print("migrated {} {} objects".format(count, name))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+""" Flush module: classes of the Base file store with unsaved changes
+"""
+import threading
+
+
+DIRTY = {}
+DIRTY_LOCK = threading.Condition()
+FLUSHER = None
+INTERVAL = None
+
+
+def flush_dirty():
+    """ Write every class that has unsaved changes
+    """
+    with DIRTY_LOCK:
+        dirty = [entry[0] for entry in DIRTY.values()]
+    for cls in dirty:
+        cls._flush_if_dirty()
+
+
+def flush_periodically():
+    """ Flush dirty classes every INTERVAL seconds, or as soon as one
+    reaches its threshold, while INTERVAL is set
+    """
+    while True:
+        with DIRTY_LOCK:
+            DIRTY_LOCK.wait(INTERVAL)
+            if INTERVAL is None:
+                continue
+        flush_dirty()
+
+
+def mark_dirty(cls: type, obj_id: str, interval: float = None,
+               threshold: int = None):
+    """ Leave a class to be written by the next flush, keeping the IDs of
+    the objects changed until then
+
+    With an interval, flushes run on a background thread; otherwise
+    only at exit.
+    """
+    global FLUSHER, INTERVAL
+    with DIRTY_LOCK:
+        entry = DIRTY.setdefault(cls.__name__, [cls, 0, set()])
+        entry[1] += 1
+        entry[2].add(obj_id)
+        INTERVAL = interval
+        if interval is None:
+            return
+        if FLUSHER is None:
+            FLUSHER = threading.Thread(target=flush_periodically,
+                                       daemon=True)
+            FLUSHER.start()
+        if threshold is not None and entry[1] >= threshold:
+            DIRTY_LOCK.notify()
+
+
+def dirty_ids(s_class: str) -> set:
+    """ Return the IDs of the objects of a class changed since its last
+    flush
+    """
+    with DIRTY_LOCK:
+        entry = DIRTY.get(s_class)
+        return set(entry[2]) if entry is not None else set()
+
+
+def take_dirty(s_class: str) -> set:
+    """ Return the IDs of the objects of a class changed since its last
+    flush and forget them, None if it has no unsaved changes
+    """
+    with DIRTY_LOCK:
+        entry = DIRTY.pop(s_class, None)
+    return entry[2] if entry is not None else None
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+""" Index module: in-memory indexes of the Base file store
+"""
+from typing import Iterator, TypeVar
+from models.query import ANY, After, In, Prefix, sort_key
+import bisect
+
+
+class Index():
+    """ Hash index of the objects of a class by one attribute
+
+    Buckets are tuples, replaced and never mutated, so readers take no
+    lock. Sorted values are kept in place; readers get a copy.
+    """
+
+    def __init__(self, attribute: str):
+        """ Initialize an empty index on attribute
+        """
+        self.attribute = attribute
+        self.buckets = {}
+        self.values = {}
+        self.version = 0
+        self.sorted = (-1, [])
+
+    def add(self, obj: TypeVar('Base')):
+        """ Index an object under its current attribute value
+        """
+        self.put(obj.id, getattr(obj, self.attribute, None))
+
+    def put(self, obj_id: str, value):
+        """ Index an object ID under value
+        """
+        if obj_id in self.values:
+            if self.values[obj_id] == value:
+                return
+            old = self.values[obj_id]
+            self._insert(obj_id, value)
+            self._drop(obj_id, old)
+            return
+        self._insert(obj_id, value)
+
+    def _insert(self, obj_id: str, value):
+        """ Add an object ID to the bucket of value
+        """
+        bucket = self.buckets.get(value)
+        self.buckets[value] = (bucket or ()) + (obj_id,)
+        self.values[obj_id] = value
+        if bucket is None:
+            self._resort(value, True)
+
+    def discard(self, obj_id: str):
+        """ Forget an object
+        """
+        if obj_id in self.values:
+            self._drop(obj_id, self.values.pop(obj_id))
+
+    def _drop(self, obj_id: str, value):
+        """ Remove an object ID from the bucket of value
+        """
+        bucket = tuple(i for i in self.buckets[value] if i != obj_id)
+        if bucket:
+            self.buckets[value] = bucket
+        else:
+            del self.buckets[value]
+            self._resort(value, False)
+
+    def _resort(self, value, added: bool):
+        """ Count a value added or removed, keeping the sorted values if
+        they are up to date
+        """
+        version, keys = self.sorted
+        current = version == self.version
+        self.version += 1
+        if not current:
+            return
+        if added:
+            bisect.insort(keys, value, key=sort_key)
+        else:
+            idx = bisect.bisect_left(keys, sort_key(value), key=sort_key)
+            if idx == len(keys) or keys[idx] != value:
+                return
+            del keys[idx]
+        self.sorted = (self.version, keys)
+
+    def keys(self) -> list:
+        """ Return a copy of the indexed values in sort_key order
+        """
+        version, keys = self.sorted
+        if version != self.version:
+            version = self.version
+            keys = sorted(list(self.buckets), key=sort_key)
+            self.sorted = (version, keys)
+        return list(keys)
+
+    def ids(self, expected=ANY, reverse: bool = False) -> Iterator[str]:
+        """ Yield the IDs of the objects whose value matches expected, by
+        value in sort_key order
+        """
+        if isinstance(expected, After):
+            keys = self.keys()
+            keys = keys[bisect.bisect_right(keys, sort_key(expected.value),
+                                            key=sort_key):]
+        elif isinstance(expected, Prefix):
+            keys = self.keys()
+            low = bisect.bisect_left(keys, sort_key(expected.prefix),
+                                     key=sort_key)
+            upper = expected.upper()
+            high = len(keys) if upper is None else bisect.bisect_left(
+                keys, sort_key(upper), key=sort_key)
+            keys = keys[low:high]
+        elif isinstance(expected, In):
+            keys = sorted((v for v in expected.values if v in self.buckets),
+                          key=sort_key)
+        elif expected is ANY:
+            keys = self.keys()
+        else:
+            keys = [expected]
+        for value in reversed(keys) if reverse else keys:
+            bucket = self.buckets.get(value, ())
+            yield from reversed(bucket) if reverse else bucket
+
+
+class IdSet(set):
+    """ IDs of the objects of a class, each being its own bucket
+    """
+
+    def get(self, obj_id: str, default: tuple = None) -> tuple:
+        """ Return the bucket of an ID
+        """
+        return (obj_id,) if obj_id in self else default
+
+
+class IdIndex(Index):
+    """ Index of the objects of a class by ID, only kept for ordering
+    """
+
+    def __init__(self):
+        """ Initialize an empty index on id
+        """
+        super().__init__('id')
+        self.buckets = IdSet()
+
+    def put(self, obj_id: str, value):
+        """ Index an object ID
+        """
+        if obj_id not in self.buckets:
+            self.buckets.add(obj_id)
+            self._resort(obj_id, True)
+
+    def discard(self, obj_id: str):
+        """ Forget an object
+        """
+        if obj_id in self.buckets:
+            self.buckets.discard(obj_id)
+            self._resort(obj_id, False)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+""" Journal module: append-only logs of the changes of the Base file store
+
+Locks are taken in this order: COMPACT_LOCK, the lock file of the class,
+the lock of the class, JOURNAL_LOCK, then the flock of the journal.
+"""
+from contextlib import contextmanager
+from typing import Callable, IO, Iterator, Tuple
+from os import path
+import fcntl
+import json
+import os
+import threading
+
+
+JOURNALS = {}
+COMPACTING = set()
+JOURNAL_LOCK = threading.Lock()
+COMPACT_LOCK = threading.RLock()
+LOCK_FILES = {}
+
+
+def replay(cls: type, objs: dict, indexes: dict, journal_path: str,
+           offset: int = 0, repair: bool = True) -> int:
+    """ Apply the records of a journal from offset to objects of cls and
+    their indexes, returns the offset past the last record applied
+
+    A torn last record is cut off if repair is set, else left for later.
+    """
+    try:
+        f = open(journal_path, 'rb')
+    except FileNotFoundError:
+        return offset
+    with f:
+        if repair:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(offset)
+        good = offset
+        for line in f:
+            if not line.endswith(b"\n") and not repair:
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record['op'] == 'save':
+                obj = cls(**record['obj'])
+                objs[obj.id] = obj
+                for index in indexes.values():
+                    index.add(obj)
+            elif record['id'] in objs:
+                del objs[record['id']]
+                for index in indexes.values():
+                    index.discard(record['id'])
+            good += len(line)
+        size = os.fstat(f.fileno()).st_size
+        if repair and good < size:
+            os.truncate(journal_path, good)
+    return good
+
+
+def append(s_class: str, journal_path: str, line: str,
+           fsync: bool = False) -> Tuple[int, int, int]:
+    """ Append a record to the journal of a class, holding JOURNAL_LOCK,
+    returns the inode of the journal and the offsets of the record
+    """
+    journal = open_journal(s_class, journal_path)
+    try:
+        start = journal.seek(0, os.SEEK_END)
+        journal.write(line)
+        journal.flush()
+        if fsync:
+            os.fsync(journal.fileno())
+        return os.fstat(journal.fileno()).st_ino, start, journal.tell()
+    finally:
+        fcntl.flock(journal, fcntl.LOCK_UN)
+
+
+def open_journal(s_class: str, journal_path: str) -> IO:
+    """ Return the journal of a class, open and flocked, holding
+    JOURNAL_LOCK; reopened if a compaction has moved it aside
+    """
+    while True:
+        journal = JOURNALS.get(s_class)
+        if journal is None:
+            journal = open(journal_path, 'a')
+            JOURNALS[s_class] = journal
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        try:
+            current = os.stat(journal_path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current == os.fstat(journal.fileno()).st_ino:
+            return journal
+        del JOURNALS[s_class]
+        journal.close()
+
+
+def drop_journal(s_class: str, ino: int = None):
+    """ Close the journal handle of a class, unless it is open on the file
+    of inode ino, holding JOURNAL_LOCK
+    """
+    journal = JOURNALS.get(s_class)
+    if journal is not None \
+            and os.fstat(journal.fileno()).st_ino != ino:
+        del JOURNALS[s_class]
+        journal.close()
+
+
+def rotate(s_class: str, journal_path: str, old_path: str,
+           catch_up: Callable[[int], None]):
+    """ Set the journal of a class aside as journal.old, holding
+    JOURNAL_LOCK
+
+    The journal stays flocked from catch_up, called with its inode to
+    replay the records not read yet, until it is moved.
+    """
+    drop_journal(s_class)
+    try:
+        f = open(journal_path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        catch_up(os.fstat(f.fileno()).st_ino)
+        if path.exists(old_path):
+            with open(old_path, 'ab') as dst:
+                dst.write(f.read())
+            os.remove(journal_path)
+        else:
+            os.replace(journal_path, old_path)
+
+
+@contextmanager
+def lock_file(s_class: str, lock_path: str, operation: int) -> Iterator[None]:
+    """ Hold the lock file of the journals of a class, shared by loads and
+    exclusive to compactions, with COMPACT_LOCK held; reentrant
+    """
+    if s_class in LOCK_FILES:
+        yield
+        return
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, operation)
+        LOCK_FILES[s_class] = f
+        try:
+            yield
+        finally:
+            del LOCK_FILES[s_class]
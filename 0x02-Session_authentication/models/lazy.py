@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+""" Lazy module: objects of a class built from their file on first access
+"""
+from collections.abc import MutableMapping
+from typing import Iterator, TypeVar
+import json
+import mmap
+import threading
+
+
+class LazyEntry():
+    """ Location of an object not built yet in its class file
+    """
+
+    __slots__ = ('mapped', 'start', 'end')
+
+    def __init__(self, mapped: mmap.mmap, start: int, end: int):
+        """ Initialize an entry spanning mapped[start:end]
+        """
+        self.mapped = mapped
+        self.start = start
+        self.end = end
+
+    def to_json(self) -> dict:
+        """ Return the serialized object
+        """
+        return json.loads(self.mapped[self.start:self.end])
+
+
+class LazyObjects(MutableMapping):
+    """ Objects of a class by ID, built from their file on first access
+
+    Only construction is deferred: opening still parses every object once
+    to fill the indexes. The file stays memory-mapped, as it is only ever
+    replaced.
+    """
+
+    def __init__(self, cls: type, file_path: str):
+        """ Initialize the objects of cls stored in file_path
+        """
+        self.cls = cls
+        self.entries = {}
+        self.building = threading.Lock()
+        self.indexes = cls._new_indexes()
+        with open(file_path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with memoryview(mapped) as view:
+            text = str(view, 'utf-8')
+        if len(text) != len(mapped):
+            raise ValueError("{} is not ASCII".format(file_path))
+        decoder = json.JSONDecoder()
+        skip = json.decoder.WHITESPACE.match
+        idx = skip(text, 0).end()
+        if text[idx] != '{':
+            raise ValueError("{} is not a JSON object".format(file_path))
+        idx = skip(text, idx + 1).end()
+        while text[idx] != '}':
+            obj_id, idx = decoder.raw_decode(text, idx)
+            idx = skip(text, skip(text, idx).end() + 1).end()
+            obj_json, end = decoder.raw_decode(text, idx)
+            self.entries[obj_id] = LazyEntry(mapped, idx, end)
+            for attr, index in self.indexes.items():
+                index.put(obj_id, obj_json.get(attr))
+            idx = skip(text, end).end()
+            if text[idx] == ',':
+                idx = skip(text, idx + 1).end()
+
+    def __getitem__(self, obj_id: str) -> TypeVar('Base'):
+        """ Return an object, building it on first access
+        """
+        entry = self.entries[obj_id]
+        if isinstance(entry, LazyEntry):
+            with self.building:
+                entry = self.entries[obj_id]
+                if isinstance(entry, LazyEntry):
+                    entry = self.cls(**entry.to_json())
+                    self.entries[obj_id] = entry
+        return entry
+
+    def __setitem__(self, obj_id: str, obj: TypeVar('Base')):
+        """ Store an object
+        """
+        self.entries[obj_id] = obj
+
+    def __delitem__(self, obj_id: str):
+        """ Forget an object
+        """
+        del self.entries[obj_id]
+
+    def __iter__(self) -> Iterator[str]:
+        """ Iterate over the IDs
+        """
+        return iter(list(self.entries))
+
+    def __len__(self) -> int:
+        """ Count the objects
+        """
+        return len(self.entries)
+
+    def __contains__(self, obj_id) -> bool:
+        """ Tell whether an ID is stored, without building its object
+        """
+        return obj_id in self.entries
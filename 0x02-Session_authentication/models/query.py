@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+""" Query module: predicates and ordering of Base.search
+"""
+from abc import ABC, abstractmethod
+from typing import Iterable, Tuple
+
+
+ANY = object()
+
+
+class Predicate(ABC):
+    """ Condition on the value of an attribute, in place of equality
+    """
+
+    @abstractmethod
+    def __call__(self, value) -> bool:
+        """ Tell whether a value meets the condition
+        """
+
+
+class Prefix(Predicate):
+    """ String value starting with a prefix
+    """
+
+    def __init__(self, prefix: str):
+        """ Initialize the condition on prefix
+        """
+        self.prefix = prefix
+
+    def __call__(self, value) -> bool:
+        """ Tell whether a value starts with the prefix
+        """
+        return isinstance(value, str) and value.startswith(self.prefix)
+
+    def upper(self) -> str:
+        """ Return the smallest string above all those with the prefix,
+        None if there is none
+        """
+        prefix = self.prefix.rstrip(chr(0x10ffff))
+        if not prefix:
+            return None
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class After(Predicate):
+    """ Value greater than a value, as a cursor past it
+    """
+
+    def __init__(self, value):
+        """ Initialize the condition on value
+        """
+        self.value = value
+
+    def __call__(self, value) -> bool:
+        """ Tell whether a value comes after the value
+        """
+        return value is not None and value > self.value
+
+
+class In(Predicate):
+    """ Value among a set of values
+    """
+
+    def __init__(self, values: Iterable):
+        """ Initialize the condition on values
+        """
+        self.values = frozenset(values)
+
+    def __call__(self, value) -> bool:
+        """ Tell whether a value is one of the values
+        """
+        try:
+            return value in self.values
+        except TypeError:
+            return False
+
+
+def matches(value, expected) -> bool:
+    """ Tell whether a value is equal to expected or meets its condition
+    """
+    if isinstance(expected, Predicate):
+        return expected(value)
+    return value == expected
+
+
+def sort_key(value) -> tuple:
+    """ Return the sort key of a value, None coming first as in SQL
+    """
+    return (value is not None, value)
+
+
+def ordering(order_by: str) -> Tuple[str, bool]:
+    """ Return the attribute of an order_by and whether the order is
+    descending, as written with a leading '-'
+    """
+    if order_by.startswith('-'):
+        return order_by[1:], True
+    return order_by, False
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+""" Shard module: objects of a class split across files by ID
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from typing import Iterator, Tuple
+from models.codec import Codec, file_path, foreign_paths, read, shard_of
+from models.codec import shard_paths
+from models.index import Index
+import glob
+
+
+class ShardIndex(Index):
+    """ Index of the objects of a class by shard, so that one shard is
+    written without going through every ID
+    """
+
+    def __init__(self, shards: int):
+        """ Initialize an empty index over shards
+        """
+        super().__init__('id')
+        self.shards = shards
+        self.buckets = {shard: set() for shard in range(shards)}
+
+    def put(self, obj_id: str, value):
+        """ Index an object ID in its shard
+        """
+        self.buckets[shard_of(obj_id, self.shards)].add(obj_id)
+
+    def discard(self, obj_id: str):
+        """ Forget an object
+        """
+        self.buckets[shard_of(obj_id, self.shards)].discard(obj_id)
+
+    def members(self, shard: int) -> list:
+        """ Return the IDs of the objects of a shard
+        """
+        return list(self.buckets[shard])
+
+
+def stray_paths(s_class: str, extension: str, shards: int) -> list:
+    """ Return the existing files of a class left by another number of
+    shards than shards
+    """
+    prefix, suffix = file_path(s_class, ''), "." + extension
+    strays = []
+    for stray in glob.glob(glob.escape(prefix) + "*" + glob.escape(suffix)):
+        shard = stray[len(prefix):-len(suffix)]
+        if shard.isdigit() and (shards == 1 or int(shard) >= shards):
+            strays.append(stray)
+    unsharded = file_path(s_class, extension)
+    if shards > 1 and path.exists(unsharded):
+        strays.append(unsharded)
+    return sorted(strays)
+
+
+def check_layout(s_class: str, codec: Codec, shards: int):
+    """ Raise a ValueError if files of a class were written with another
+    number of shards or another codec
+    """
+    strays = stray_paths(s_class, codec.extension, shards)
+    if strays:
+        raise ValueError(
+            "{} belong to another number of shards than {}, reshard "
+            "them with models.codec".format(", ".join(strays), shards))
+    foreign = foreign_paths(s_class, codec.extension)
+    if foreign:
+        raise ValueError(
+            "{} were written by another codec than {}, convert them "
+            "with python3 -m models.codec".format(", ".join(foreign),
+                                                  codec.name))
+
+
+def read_shards(s_class: str, codec: Codec,
+                shards: int) -> Iterator[Tuple[str, dict]]:
+    """ Yield the (id, serialized object) pairs of the shard files of a
+    class, read in parallel threads
+    """
+    paths = shard_paths(s_class, codec.extension, shards)
+    with ThreadPoolExecutor(shards) as executor:
+        for shard, pairs in enumerate(executor.map(
+                lambda p: read(codec, p), paths)):
+            for obj_id, obj_json in pairs:
+                if shard_of(obj_id, shards) != shard:
+                    raise ValueError("{} holds objects of another number "
+                                     "of shards".format(paths[shard]))
+                yield obj_id, obj_json
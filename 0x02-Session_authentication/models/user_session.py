@@ -7,6 +7,9 @@ from models.base import Base
 class UserSession(Base):
     """Representation of a user's session."""
 
+    __slots__ = ("user_id", "session_id")
+    INDEXED = ("session_id",)
+
     def __init__(self, *args: list, **kwargs: dict):
         """Initialize a UserSession with user and session information."""
         super().__init__(*args, **kwargs)
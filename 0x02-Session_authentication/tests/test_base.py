@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+""" Tests of the file store and the storage engines of the Base model
+
+usage: python3 -m unittest discover tests, from 0x02-Session_authentication
+"""
+from models.codec import convert, shard_of
+from models.engine import SQLiteEngine, migrate
+from models.flush import DIRTY, flush_dirty
+from models.index import Index, IdIndex
+from models.journal import COMPACT_LOCK, JOURNALS
+from models.query import After, In, Prefix, sort_key
+from models.user import User
+import models.base as base
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+
+class IndexTestCase(unittest.TestCase):
+    """ Sorted values of the indexes
+    """
+
+    def test_keys(self):
+        """ The sorted values follow the values added and removed
+        """
+        rand = random.Random(0)
+        for index in (Index('email'), IdIndex()):
+            for step in range(2000):
+                obj_id = str(rand.randrange(300))
+                value = rand.choice([None, rand.randrange(50)])
+                if rand.random() < 0.3:
+                    index.discard(obj_id)
+                else:
+                    index.put(obj_id, value)
+                if step % 7 == 0:
+                    self.assertEqual(index.keys(), sorted(
+                        index.buckets, key=sort_key))
+
+
+class StoreTestCase(unittest.TestCase):
+    """ User objects stored in files, in a temporary directory
+    """
+
+    STORAGE = 'file'
+    FLUSH_POLICY = 'write'
+    SHARDS = 1
+
+    def setUp(self):
+        """ Start from an empty store in the STORAGE mode
+        """
+        cwd = os.getcwd()
+        tmp = tempfile.TemporaryDirectory()
+        os.chdir(tmp.name)
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(os.chdir, cwd)
+        for name, value in (('STORAGE', self.STORAGE),
+                            ('FLUSH_POLICY', self.FLUSH_POLICY),
+                            ('FLUSH_INTERVAL', 0.001),
+                            ('FLUSH_THRESHOLD', 10),
+                            ('JOURNAL_MAX_BYTES', 1024 * 1024),
+                            ('LAZY_LOAD', False), ('SHARDS', self.SHARDS),
+                            ('ENGINE', None)):
+            self.addCleanup(setattr, base, name, getattr(base, name))
+            setattr(base, name, value)
+        self.addCleanup(self.forget)
+        self.forget()
+        User.load_from_file()
+
+    def forget(self):
+        """ Drop what the process holds of the User store
+        """
+        journal = JOURNALS.pop('User', None)
+        if journal is not None:
+            journal.close()
+        for store in (base.DATA, base.INDEXES, base.STATES, DIRTY):
+            store.pop('User', None)
+
+    def reload(self) -> dict:
+        """ Reload the User store from its files, returns emails by ID
+        """
+        self.forget()
+        User.load_from_file()
+        return {obj.id: obj.email for obj in User.all()}
+
+    def save_elsewhere(self, email: str, compact: bool = False) -> str:
+        """ Save a user from another process, compacting if compact is
+        set, returns its ID
+        """
+        code = ("from models.user import User\n"
+                "User.load_from_file()\n"
+                "user = User(email={!r})\n"
+                "user.save()\n"
+                "if {!r}:\n"
+                "    User.save_to_file()\n"
+                "print(user.id)\n").format(email, compact)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(
+            os.path.dirname(os.path.abspath(base.__file__))),
+            BASE_FLUSH_POLICY='write', BASE_STORAGE=self.STORAGE)
+        return subprocess.run([sys.executable, '-c', code], env=env,
+                              check=True, capture_output=True,
+                              text=True).stdout.strip()
+
+
+class BatchTestCase(StoreTestCase):
+    """ Batches of the file store
+    """
+
+    def test_rollback(self):
+        """ A failed batch puts back what it changed, even once another
+        thread has written the class
+        """
+        kept, removed = User(email="kept@x.io"), User(email="removed@x.io")
+        kept.save()
+        removed.save()
+
+        def save_other():
+            User(email="other@x.io").save()
+
+        with self.assertRaises(RuntimeError):
+            with User.batch():
+                User(email="uncommitted@x.io").save()
+                kept.first_name = "Bob"
+                kept.save()
+                removed.remove()
+                writer = threading.Thread(target=save_other)
+                writer.start()
+                writer.join()
+                raise RuntimeError()
+        emails = {obj.email for obj in User.all()}
+        self.assertEqual(emails, {"kept@x.io", "removed@x.io", "other@x.io"})
+        self.assertIsNone(User.get(kept.id).first_name)
+        self.assertEqual(User.search({'email': "uncommitted@x.io"}), [])
+        self.assertEqual(set(self.reload().values()), emails)
+
+    def test_commit(self):
+        """ A batch writes its changes once, on exit
+        """
+        with User.batch():
+            users = [User(email="{}@x.io".format(i)) for i in range(3)]
+            for user in users:
+                user.save()
+            self.assertFalse(os.path.exists(User.file_path()))
+        self.assertEqual(self.reload(), {u.id: u.email for u in users})
+
+
+class CacheTestCase(StoreTestCase):
+    """ Serializations cached on the objects
+    """
+
+    def test_save_caches_nothing(self):
+        """ Saving writes an object without caching its serialization
+        """
+        user = User(email="saved@x.io")
+        user.save()
+        User.save_to_file()
+        self.assertFalse(getattr(user, '_cache', None))
+        user.to_json_bytes()
+        self.assertFalse(getattr(user, '_cache', {}).get('bytes'))
+
+
+class FlushTestCase(StoreTestCase):
+    """ Writes deferred to a background flush
+    """
+
+    FLUSH_POLICY = 'interval'
+
+    def test_reload_during_flush(self):
+        """ Reloads running while changes are flushed in the background
+        lose no change
+        """
+        errors = []
+        done = threading.Event()
+
+        def reload():
+            while not done.is_set():
+                try:
+                    User.load_from_file()
+                except Exception as e:
+                    errors.append(e)
+
+        reloader = threading.Thread(target=reload)
+        reloader.start()
+        try:
+            ids = set()
+            for i in range(1200):
+                user = User(email="{}@x.io".format(i))
+                user.save()
+                ids.add(user.id)
+        finally:
+            done.set()
+            reloader.join()
+        flush_dirty()
+        self.assertEqual(errors, [])
+        self.assertEqual({user.id for user in User.all()}, ids)
+        self.assertEqual(set(self.reload()), ids)
+
+
+class RefreshTestCase(StoreTestCase):
+    """ Writes of other processes seen by refresh_if_changed, with
+    writes deferred to a flush
+    """
+
+    FLUSH_POLICY = 'shutdown'
+
+    def test_refresh_keeps_pending(self):
+        """ A refresh merges the unflushed changes of this process with
+        the files, which the next flush does not overwrite
+        """
+        removed = User(email="removed@x.io")
+        removed.save()
+        flush_dirty()
+        local = User(email="local@x.io")
+        local.save()
+        removed.remove()
+        other = self.save_elsewhere("other@x.io")
+        self.assertTrue(User.refresh_if_changed())
+        self.assertIs(User.get(local.id), local)
+        self.assertIsNone(User.get(removed.id))
+        self.assertEqual(User.get(other).email, "other@x.io")
+        flush_dirty()
+        self.assertEqual(self.reload(), {local.id: "local@x.io",
+                                         other: "other@x.io"})
+
+
+class ShardTestCase(StoreTestCase):
+    """ User objects split across shard files
+    """
+
+    SHARDS = 4
+
+    def test_write_shard(self):
+        """ Each save rewrites the shard of the object, and only it
+        """
+        users = [User(email="{}@x.io".format(i)) for i in range(20)]
+        for user in users:
+            user.save()
+        users[0].remove()
+        for shard in range(self.SHARDS):
+            with open(User.file_path(shard=shard)) as f:
+                ids = set(json.load(f))
+            self.assertEqual(ids, {
+                u.id for u in users[1:]
+                if shard_of(u.id, self.SHARDS) == shard})
+        self.assertEqual(self.reload(), {u.id: u.email for u in users[1:]})
+
+    def test_other_layout(self):
+        """ Files of another number of shards are not loaded
+        """
+        users = [User(email="{}@x.io".format(i)) for i in range(20)]
+        for user in users:
+            user.save()
+        base.SHARDS = 8
+        self.forget()
+        self.assertRaises(ValueError, User.load_from_file)
+        base.SHARDS = 1
+        self.assertRaises(ValueError, User.load_from_file)
+        base.SHARDS = 4
+        with open(User.file_path(), 'w') as f:
+            f.write("{}")
+        self.assertRaises(ValueError, User.load_from_file)
+
+
+class CodecTestCase(StoreTestCase):
+    """ User objects written by one codec, read with another
+    """
+
+    def test_other_codec(self):
+        """ Files of another codec are not loaded until converted
+        """
+        user = User(email="kept@x.io")
+        user.save()
+        with mock.patch.dict(os.environ, BASE_CODEC='ndjson'):
+            self.forget()
+            self.assertRaises(ValueError, User.load_from_file)
+            convert('User', 'json', 'ndjson')
+            self.assertEqual(self.reload(), {user.id: "kept@x.io"})
+
+
+class JournalTestCase(StoreTestCase):
+    """ User objects stored in journal mode
+    """
+
+    STORAGE = 'journal'
+
+    def test_replay(self):
+        """ Saves and removes are replayed from the journal
+        """
+        users = [User(email="{}@x.io".format(i)) for i in range(3)]
+        for user in users:
+            user.save()
+        users[0].email = "changed@x.io"
+        users[0].save()
+        users[1].remove()
+        self.assertFalse(os.path.exists(User.file_path()))
+        self.assertEqual(self.reload(), {users[0].id: "changed@x.io",
+                                         users[2].id: "2@x.io"})
+        self.assertEqual(len(User.search({'email': "changed@x.io"})), 1)
+
+    def test_torn_record(self):
+        """ A record cut short by a crash is dropped from the journal
+        """
+        user = User(email="kept@x.io")
+        user.save()
+        journal_path = User.file_path('journal')
+        size = os.path.getsize(journal_path)
+        JOURNALS.pop('User').close()
+        with open(journal_path, 'a') as f:
+            f.write('{"op": "save", "id": "torn", "obj": {"id": "to')
+        self.assertEqual(self.reload(), {user.id: "kept@x.io"})
+        self.assertEqual(os.path.getsize(journal_path), size)
+        other = User(email="next@x.io")
+        other.save()
+        self.assertEqual(self.reload(), {user.id: "kept@x.io",
+                                         other.id: "next@x.io"})
+
+    def test_compaction(self):
+        """ A compaction folds the journal into the snapshot
+        """
+        users = [User(email="{}@x.io".format(i)) for i in range(5)]
+        for user in users:
+            user.save()
+        users[4].remove()
+        User.save_to_file()
+        self.assertTrue(os.path.exists(User.file_path()))
+        self.assertFalse(os.path.exists(User.file_path('journal')))
+        self.assertFalse(os.path.exists(User.file_path('journal.old')))
+        expected = {u.id: u.email for u in users[:4]}
+        self.assertEqual(self.reload(), expected)
+        self.assertFalse(User.refresh_if_changed())
+
+    def test_refresh_own_appends(self):
+        """ The records this process appends are not read back
+        """
+        user = User(email="own@x.io")
+        user.save()
+        version = User.class_version()
+        self.assertFalse(User.refresh_if_changed())
+        self.assertIs(User.get(user.id), user)
+        self.assertEqual(User.class_version(), version)
+
+    def test_compaction_keeps_others(self):
+        """ A compaction keeps the records of other processes that this
+        one has not read
+        """
+        local = User(email="local@x.io")
+        local.save()
+        other = self.save_elsewhere("other@x.io")
+        User.save_to_file()
+        self.assertFalse(os.path.exists(User.file_path('journal')))
+        self.assertEqual(self.reload(), {local.id: "local@x.io",
+                                         other: "other@x.io"})
+
+    def test_compaction_after_other_compaction(self):
+        """ A compaction reads the snapshot another process wrote, and
+        the batch changes of this one prevail over it
+        """
+        removed = User(email="removed@x.io")
+        removed.save()
+        with User.batch():
+            local = User(email="local@x.io")
+            local.save()
+            removed.remove()
+            other = self.save_elsewhere("other@x.io", compact=True)
+        self.assertEqual(self.reload(), {local.id: "local@x.io",
+                                         other: "other@x.io"})
+
+    def test_append_after_other_compaction(self):
+        """ Appends go to the new journal once another process has moved
+        the one this process had open aside
+        """
+        first = User(email="first@x.io")
+        first.save()
+        other = self.save_elsewhere("other@x.io", compact=True)
+        User.refresh_if_changed()
+        second = User(email="second@x.io")
+        second.save()
+        self.assertEqual(self.reload(), {first.id: "first@x.io",
+                                         other: "other@x.io",
+                                         second.id: "second@x.io"})
+
+    def test_reload_during_compaction(self):
+        """ Reloads running while full journals are compacted in the
+        background lose no record
+        """
+        base.JOURNAL_MAX_BYTES = 4096
+        errors = []
+        done = threading.Event()
+
+        def reload():
+            while not done.is_set():
+                try:
+                    User.load_from_file()
+                except Exception as e:
+                    errors.append(e)
+
+        reloader = threading.Thread(target=reload)
+        reloader.start()
+        try:
+            ids = set()
+            for i in range(1500):
+                user = User(email="{}@x.io".format(i))
+                user.save()
+                ids.add(user.id)
+        finally:
+            done.set()
+            reloader.join()
+        with COMPACT_LOCK:
+            pass
+        self.assertEqual(errors, [])
+        self.assertEqual(set(self.reload()), ids)
+
+
+class SQLiteTestCase(StoreTestCase):
+    """ User objects stored by the SQLite engine
+    """
+
+    QUERIES = (
+        ({}, {}),
+        ({'email': "3@x.io"}, {}),
+        ({'email': None}, {}),
+        ({'email': Prefix("1")}, {'order_by': 'email'}),
+        ({'email': In(["2@x.io", "4@x.io", None])}, {'order_by': '-email'}),
+        ({'last_name': "Dylan"}, {}),
+        ({}, {'order_by': 'first_name'}),
+        ({}, {'order_by': '-first_name', 'limit': 3, 'offset': 2}),
+        ({'email': Prefix("1")}, {'order_by': 'id', 'limit': 4}),
+        ({}, {'order_by': 'id', 'limit': 5, 'offset': 5}),
+    )
+
+    def setUp(self):
+        """ Start from an empty database
+        """
+        super().setUp()
+        self.engine = SQLiteEngine(os.path.abspath("db.sqlite3"))
+
+    def use_engine(self):
+        """ Store the User objects in the database from now on
+        """
+        base.ENGINE = self.engine
+        User.load_from_file()
+
+    def results(self) -> list:
+        """ Return the IDs found by each query, in order
+        """
+        results = []
+        for attributes, options in self.QUERIES:
+            found = [user.id for user in User.search(attributes, **options)]
+            if 'order_by' not in options:
+                found.sort()
+            results.append(found)
+        return results
+
+    def test_search(self):
+        """ Searches match, order and page as in the file store
+        """
+        for i in range(20):
+            User(email=None if i == 7 else "{}@x.io".format(i),
+                 first_name=None if i == 0 else "n{:02}".format(i),
+                 last_name="Dylan" if i % 5 == 1 else None).save()
+        expected = self.results()
+        self.assertEqual(migrate([User], self.engine), {'User': 20})
+        self.use_engine()
+        self.assertEqual(self.results(), expected)
+        self.assertEqual(User.search({'id': After(expected[0][-2])}),
+                         [User.get(expected[0][-1])])
+
+    def test_rollback(self):
+        """ A failed batch is one transaction rolled back
+        """
+        self.use_engine()
+        kept = User(email="kept@x.io")
+        kept.save()
+        with self.assertRaises(RuntimeError):
+            with User.batch():
+                User(email="uncommitted@x.io").save()
+                kept.first_name = "Bob"
+                kept.save()
+                raise RuntimeError()
+        self.assertEqual([user.id for user in User.all()], [kept.id])
+        self.assertIsNone(User.get(kept.id).first_name)
+
+    def test_versions(self):
+        """ Each change bumps the version of the class, and each save the
+        version of the object, even from copies of it
+        """
+        self.use_engine()
+        user = User(email="v@x.io")
+        user.save()
+        self.assertEqual((user.version, User.class_version()), (1, 1))
+        first, second = User.get(user.id), User.get(user.id)
+        first.first_name = "First"
+        first.save()
+        second.first_name = "Second"
+        second.save()
+        self.assertEqual((first.version, second.version), (2, 3))
+        self.assertEqual(User.get(user.id).version, 3)
+        second.remove()
+        self.assertEqual(User.class_version(), 4)
+        scope = base.version_scope()
+        self.assertTrue(scope.startswith("sqlite."))
+        base.ENGINE = SQLiteEngine(os.path.abspath("other.sqlite3"))
+        User.load_from_file()
+        self.assertNotEqual(base.version_scope(), scope)
+
+    def test_new_columns(self):
+        """ Opening a table adds the columns of new fields, the rows
+        already stored reading None for them
+        """
+        with sqlite3.connect(self.engine.db_path) as conn:
+            conn.execute('CREATE TABLE "User" ("id" TEXT PRIMARY KEY NOT '
+                         'NULL, "email" TEXT)')
+            conn.execute('INSERT INTO "User" VALUES (\'old\', \'o@x.io\')')
+        conn.close()
+        self.use_engine()
+        user = User.get('old')
+        self.assertEqual((user.email, user.first_name), ("o@x.io", None))
+        user.save()
+        self.assertEqual(User.get('old').version, 1)
+
+    def test_migrate_command(self):
+        """ The migrate command copies the class files to the database
+        """
+        users = [User(email="{}@x.io".format(i)) for i in range(3)]
+        for user in users:
+            user.save()
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(
+            os.path.dirname(os.path.abspath(base.__file__))),
+            BASE_SQLITE_PATH=self.engine.db_path)
+        env.pop('BASE_ENGINE', None)
+        result = subprocess.run(
+            [sys.executable, '-m', 'models.engine', 'migrate', 'User'],
+            env=env, check=True, capture_output=True, text=True)
+        self.assertEqual(result.stdout, "migrated 3 User objects\n")
+        self.use_engine()
+        self.assertEqual({user.id for user in User.all()},
+                         {user.id for user in users})
+
+
+if __name__ == "__main__":
+    unittest.main()
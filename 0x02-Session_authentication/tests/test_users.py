@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+""" Tests of the users views
+
+usage: python3 -m unittest discover tests, from 0x02-Session_authentication
+"""
+from api.v1 import app as app_module
+from models.user import User
+from test_base import StoreTestCase
+from unittest import mock
+import unittest
+
+
+class UsersViewTestCase(StoreTestCase):
+    """ GET, PUT and DELETE of /api/v1/users, without authentication
+    """
+
+    def setUp(self):
+        """ Start from five users and a test client
+        """
+        super().setUp()
+        patcher = mock.patch.object(app_module, 'auth', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app_module.app.test_client()
+        self.users = [User(email="{}@x.io".format(i)) for i in range(5)]
+        for user in self.users:
+            user.save()
+
+    def etag(self, url: str) -> str:
+        """ Return the ETag of a GET of url
+        """
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.headers['ETag']
+
+    def get(self, url: str, etag: str) -> int:
+        """ Return the status of a GET of url with If-None-Match: etag
+        """
+        return self.client.get(url, headers={'If-None-Match': etag}
+                               ).status_code
+
+    def test_not_modified(self):
+        """ Both routes answer 304 to the ETag they sent
+        """
+        for url in ("/api/v1/users", "/api/v1/users?limit=2",
+                    "/api/v1/users/{}".format(self.users[0].id)):
+            self.assertEqual(self.get(url, self.etag(url)), 304)
+
+    def test_etag_changes(self):
+        """ A PUT or a DELETE changes the ETags of the users it touches
+        """
+        user_url = "/api/v1/users/{}".format(self.users[0].id)
+        list_tag, user_tag = self.etag("/api/v1/users"), self.etag(user_url)
+        response = self.client.put(user_url, json={'first_name': "Bob"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get("/api/v1/users", list_tag), 200)
+        self.assertEqual(self.get(user_url, user_tag), 200)
+        list_tag = self.etag("/api/v1/users")
+        response = self.client.delete(user_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get("/api/v1/users", list_tag), 200)
+        self.assertEqual(self.client.get(user_url).status_code, 404)
+
+    def test_bad_limit(self):
+        """ A bad limit is refused, even with a matching ETag
+        """
+        etag = self.etag("/api/v1/users")
+        for limit in ("abc", "0", "-1", "1001"):
+            url = "/api/v1/users?limit={}".format(limit)
+            self.assertEqual(self.get(url, etag), 400)
+
+    def test_pages(self):
+        """ Pages follow one another by ID up to the last one, which has
+        no next page
+        """
+        ids, url, pages = [], "/api/v1/users?limit=2", 0
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = [user['id'] for user in response.get_json()]
+            ids.extend(page)
+            pages += 1
+            cursor = response.headers.get('X-Next-Cursor')
+            if cursor is None:
+                self.assertNotIn('Link', response.headers)
+                url = None
+                continue
+            self.assertEqual(cursor, page[-1])
+            link = response.headers['Link']
+            self.assertTrue(link.endswith('>; rel="next"'))
+            url = link[1:link.index('>')]
+        self.assertEqual(ids, sorted(user.id for user in self.users))
+        self.assertEqual(pages, 3)
+
+    def test_stream(self):
+        """ A streamed listing has the bytes of the one built at once
+        """
+        for url in ("/api/v1/users", "/api/v1/users?limit=2"):
+            whole = self.client.get(url)
+            streamed = self.client.get(url + ("&" if "?" in url else "?")
+                                       + "stream=1")
+            self.assertTrue(streamed.is_streamed)
+            self.assertEqual(streamed.get_data(), whole.get_data())
+            self.assertEqual(streamed.headers['ETag'], whole.headers['ETag'])
+
+
+if __name__ == "__main__":
+    unittest.main()